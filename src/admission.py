@@ -0,0 +1,93 @@
+import threading
+
+from scheduler import ewma
+
+
+class AdmissionController:
+    """
+    Decides whether a job can finish within its deadline before it is queued.
+
+    The estimate is based on the queue depth of the ComfyUI backends, as read from
+    /queue by the backend pool, the jobs waiting in the scheduler and the observed
+    execution time of every template. Jobs that would not finish in time are
+    rejected right away, so runpod can hand them to another worker instead of letting
+    them run into the polling budget here.
+    """
+
+    def __init__(self, pool, scheduler):
+        self.pool = pool
+        self.scheduler = scheduler
+        # Average execution time in seconds, by template
+        self.execution_times = {}
+        self._lock = threading.Lock()
+
+    def record(self, template, execution_time):
+        """
+        Records how long a job of the template took to execute
+        """
+        with self._lock:
+            self.execution_times[template] = ewma(
+                self.execution_times.get(template), execution_time
+            )
+
+    def mean_execution_time(self):
+        """
+        Returns the average execution time over all templates, or None without data
+        """
+        with self._lock:
+            if not self.execution_times:
+                return None
+            return sum(self.execution_times.values()) / len(self.execution_times)
+
+    def estimate(self, template):
+        """
+        Estimates the seconds until a job of the template would be finished
+
+        Args:
+            template (str): The name of the template, see template_name
+
+        Returns:
+            float: The estimated seconds, or None if there is not enough data yet
+        """
+        mean = self.mean_execution_time()
+        backends = self.pool.healthy_backends()
+        if mean is None or not backends:
+            return None
+        own = self.execution_times.get(template, mean)
+        ahead = min(backend.load for backend in backends) + self.scheduler.waiting / len(
+            backends
+        )
+        return ahead * mean + own
+
+    def admit(self, template, deadline):
+        """
+        Returns the estimated seconds until the job is finished, and whether it should be run
+
+        Args:
+            template (str): The name of the template, see template_name
+            deadline (float): Seconds the job may take
+
+        Returns:
+            tuple: The structure is (estimate, admitted). Jobs without an estimate are admitted.
+        """
+        estimate = self.estimate(template)
+        return estimate, estimate is None or estimate <= deadline
+
+    def concurrency(self, maximum, deadline):
+        """
+        Returns how many jobs the worker should take at the same time
+
+        That is as many jobs as the healthy backends can finish within the deadline,
+        minus the prompts other clients queued on them, but at least one and at most maximum.
+
+        Args:
+            maximum (int): The configured maximum concurrency
+            deadline (float): Seconds a job may take
+        """
+        mean = self.mean_execution_time()
+        backends = self.pool.healthy_backends()
+        if mean is None or not backends:
+            return maximum
+        external = sum(max(0, backend.queue_depth - backend.in_flight) for backend in backends)
+        capacity = int(len(backends) * deadline / mean) - external
+        return max(1, min(maximum, capacity))
@@ -0,0 +1,186 @@
+import json
+import threading
+import time
+import urllib.request
+
+# Seconds to wait for a health check response before counting it as failed
+HEALTH_CHECK_TIMEOUT_S = 2
+
+
+def parse_backends(hosts, default_output_path):
+    """
+    Parses a comma separated list of ComfyUI backends
+
+    Each entry is either "host:port" or "host:port=/output/path", for backends that
+    write their images to a different output directory.
+
+    Args:
+        hosts (str): The list of backends, e.g. "127.0.0.1:8188,127.0.0.1:8189=/comfyui/output-1"
+        default_output_path (str): The output directory of backends without an explicit one
+
+    Returns:
+        list: A list of Backend objects
+    """
+    backends = []
+    for entry in hosts.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, output_path = entry.partition("=")
+        backends.append(Backend(host.strip(), output_path.strip() or default_output_path))
+    return backends
+
+
+class Backend:
+    """
+    A ComfyUI instance the worker can send jobs to
+    """
+
+    def __init__(self, host, output_path):
+        self.host = host
+        self.output_path = output_path
+        self.healthy = False
+        self.failures = 0
+        # Number of times the supervisor restarted ComfyUI on this backend
+        self.restarts = 0
+        # Prompts in the ComfyUI queue, as reported by /queue
+        self.queue_depth = 0
+        # Jobs of this worker that were routed to the backend and are not finished yet
+        self.in_flight = 0
+        # Models loaded by the last job that was routed to the backend
+        self.resident = frozenset()
+        # Node signatures of the last workflow executed on the backend, see node_signatures
+        self.signatures = {}
+        # Digest of the input images uploaded to the backend, by name
+        self.uploads = {}
+
+    @property
+    def url(self):
+        return f"http://{self.host}"
+
+    @property
+    def load(self):
+        # Our own jobs show up in the queue with a delay, so take whatever is higher
+        return max(self.queue_depth, self.in_flight)
+
+    def needs_swap(self, models):
+        """
+        Returns True if running a job with these models would unload the resident ones
+        """
+        return bool(models) and bool(self.resident) and not models <= self.resident
+
+    def has_models(self, models):
+        """
+        Returns True if the models are already loaded on the backend
+        """
+        return bool(models) and models <= self.resident
+
+    def __repr__(self):
+        return f"Backend({self.host})"
+
+
+class BackendPool:
+    """
+    Keeps track of the health and load of all ComfyUI backends.
+
+    A background thread polls /queue on every backend. A backend that fails
+    failure_threshold checks in a row is drained: it gets no new jobs until it answers
+    again, while the other backends keep working.
+    """
+
+    def __init__(self, backends, interval=1.0, failure_threshold=3):
+        self.backends = backends
+        self.interval = interval
+        self.failure_threshold = failure_threshold
+        # Called with a backend that became healthy, e.g. to dispatch waiting jobs
+        self.on_healthy = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def check(self, backend):
+        """
+        Checks the health of a backend and refreshes its queue depth
+
+        Returns:
+            bool: True if the backend is healthy
+        """
+        try:
+            with urllib.request.urlopen(
+                f"{backend.url}/queue", timeout=HEALTH_CHECK_TIMEOUT_S
+            ) as response:
+                queue = json.loads(response.read())
+        except Exception:
+            self.mark_failed(backend)
+            return False
+
+        backend.queue_depth = len(queue.get("queue_running", [])) + len(
+            queue.get("queue_pending", [])
+        )
+        became_healthy = not backend.healthy
+        backend.healthy = True
+        backend.failures = 0
+        if became_healthy:
+            print(f"runpod-worker-comfy - backend {backend.host} is healthy")
+            for callback in self.on_healthy:
+                callback(backend)
+        return True
+
+    def check_all(self):
+        for backend in self.backends:
+            self.check(backend)
+
+    def mark_failed(self, backend, drain=False):
+        """
+        Counts a failed request to a backend and drains it once the threshold is reached
+
+        Args:
+            backend (Backend): The backend that failed
+            drain (bool, optional): Drain the backend right away, e.g. when a job could not be queued
+        """
+        backend.failures += 1
+        if backend.healthy and (drain or backend.failures >= self.failure_threshold):
+            print(f"runpod-worker-comfy - backend {backend.host} failed, draining it")
+            backend.healthy = False
+            backend.resident = frozenset()
+            backend.signatures = {}
+
+    def start(self):
+        """
+        Starts the background health checks, if they are not running already
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self.check_all()
+            time.sleep(self.interval)
+
+    def healthy_backends(self):
+        return [backend for backend in self.backends if backend.healthy]
+
+    def select(self, models, slots=1):
+        """
+        Returns the backend a job should run on
+
+        Args:
+            models (frozenset): The model set of the job
+            slots (int, optional): Maximum number of jobs of this worker per backend
+
+        Returns:
+            Backend: A healthy backend with a free slot that already has the models
+                     loaded, otherwise the least loaded one, or None if there is none
+        """
+        candidates = [
+            backend
+            for backend in self.healthy_backends()
+            if backend.in_flight < slots
+        ]
+        if not candidates:
+            return None
+        # Resident models win over load: the queue depth is only refreshed by the
+        # health checks and may still count the job that just finished
+        return min(candidates, key=lambda backend: (not backend.has_models(models), backend.load))
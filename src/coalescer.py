@@ -0,0 +1,84 @@
+import hashlib
+import threading
+
+
+def job_key(serialized, images):
+    """
+    Returns a key that is the same for jobs that produce the same outputs
+
+    Args:
+        serialized (str): The bound workflow as JSON, see WorkflowGraph
+        images (list): The input images of the job, as sent in the input
+
+    Returns:
+        str: The key
+    """
+    digest = hashlib.sha256(serialized.encode("utf-8"))
+    for image in images or []:
+        digest.update(b"\0" + image["name"].encode("utf-8") + b"\0")
+        digest.update(image["image"].encode("utf-8"))
+    return digest.hexdigest()
+
+
+class Flight:
+    """
+    An execution that several identical jobs wait for
+    """
+
+    def __init__(self):
+        self.jobs = 1
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Coalescer:
+    """
+    Runs identical jobs that arrive while one of them is queued or running only once.
+
+    The first job with a key runs, jobs with the same key that arrive before it is
+    finished wait for it and get its result. Nothing is cached beyond that, a job that
+    arrives later runs again.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, execute):
+        """
+        Runs execute for the first job with the key, or waits for the job that does
+
+        Args:
+            key (str): The key of the job, see job_key
+            execute (callable): Runs the job and returns its result
+
+        Returns:
+            tuple: The result, the number of jobs that share it, and whether this
+                   job ran it. The structure is (result, jobs, leader).
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+            else:
+                flight.jobs += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, flight.jobs, False
+
+        try:
+            flight.result = execute()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            # Jobs that arrive from now on run again
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, flight.jobs, True
@@ -1,5 +1,3 @@
-import runpod
-from runpod.serverless.utils import rp_upload
 import json
 import urllib.request
 import urllib.parse
@@ -8,7 +6,6 @@ import os
 import requests
 import base64
 from io import BytesIO
-from PIL import Image
 
 # Time to wait between API check attempts in milliseconds
 COMFY_API_AVAILABLE_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_INTERVAL_MS", 50))
@@ -199,6 +196,9 @@ def base64_encode(img_path):
     Returns:
         str: The base64 encoded image
     """
+    # Only needed to encode the output images
+    from PIL import Image
+
     with Image.open(img_path) as img:
         # Convert RGBA/PNG to RGB/JPEG (removes alpha channel if needed)
         if img.mode in ('RGBA', 'LA'):
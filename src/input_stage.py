@@ -0,0 +1,215 @@
+import base64
+import hashlib
+import math
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import requests
+
+from tracing import NULL_TRACE
+
+# MIME types by the magic bytes at the start of the file
+MIME_TYPES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+)
+# Quality of JPEG images that were downscaled
+JPEG_QUALITY = 95
+
+
+def parse_resolutions(resolutions):
+    """
+    Parses the input resolution of each template
+
+    Args:
+        resolutions (str): A comma separated list, e.g. "workflow=1024x1024,inline-1a2b3c4d=768x768"
+
+    Returns:
+        dict: The maximum number of input pixels, by template name
+    """
+    result = {}
+    for entry in resolutions.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        template, _, resolution = entry.partition("=")
+        width, _, height = resolution.lower().partition("x")
+        result[template.strip()] = int(width) * int(height)
+    return result
+
+
+def detect_mime_type(blob):
+    """
+    Returns the MIME type of an image from its content
+    """
+    if blob[:4] == b"RIFF" and blob[8:12] == b"WEBP":
+        return "image/webp"
+    for magic, mime_type in MIME_TYPES:
+        if blob.startswith(magic):
+            return mime_type
+    return "application/octet-stream"
+
+
+class InputImage:
+    """
+    An input image, decoded and ready to be uploaded to ComfyUI
+    """
+
+    def __init__(self, name, blob):
+        self.name = name
+        self.blob = blob
+        self.mime_type = detect_mime_type(blob)
+        self.resized = False
+
+    @property
+    def digest(self):
+        return hashlib.sha256(self.blob).hexdigest()
+
+
+def downscale(blob, mime_type, max_pixels):
+    """
+    Downscales an image so that it has at most max_pixels pixels
+
+    JPEG images are decoded at a reduced scale right away, so a large photo never
+    has to be decoded at full resolution.
+
+    Args:
+        blob (bytes): The encoded image
+        mime_type (str): The MIME type of the image
+        max_pixels (int): The number of pixels the workflow works with
+
+    Returns:
+        bytes: The downscaled image in its original format, or None if it is small enough
+    """
+    # Only needed for images that have to be resized
+    from PIL import Image
+
+    with Image.open(BytesIO(blob)) as img:
+        width, height = img.size
+        if width * height <= max_pixels:
+            return None
+
+        scale = math.sqrt(max_pixels / (width * height))
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        image_format = img.format
+        # Keep the orientation of photos
+        exif = img.info.get("exif", b"")
+        if mime_type == "image/jpeg":
+            img.draft("RGB", size)
+        resized = img.resize(size, Image.LANCZOS)
+
+    buffer = BytesIO()
+    if image_format == "JPEG":
+        resized.save(buffer, format="JPEG", quality=JPEG_QUALITY, exif=exif)
+    else:
+        resized.save(buffer, format=image_format, exif=exif)
+    return buffer.getvalue()
+
+
+def prepare_image(image, max_pixels=None):
+    """
+    Decodes a base64 encoded input image and downscales it to the working resolution
+
+    Args:
+        image (dict): A dictionary containing the 'name' of the image and the 'image' as a base64 encoded string
+        max_pixels (int, optional): The number of pixels the template works with
+
+    Returns:
+        InputImage: The decoded image
+    """
+    prepared = InputImage(image["name"], base64.b64decode(image["image"]))
+    if max_pixels and prepared.mime_type != "application/octet-stream":
+        blob = downscale(prepared.blob, prepared.mime_type, max_pixels)
+        if blob is not None:
+            prepared.blob = blob
+            prepared.resized = True
+    return prepared
+
+
+def prepare_images(images, max_pixels=None, workers=4):
+    """
+    Decodes and downscales several input images in parallel
+
+    Returns:
+        list: A list of InputImage objects, in the order of the images
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda image: prepare_image(image, max_pixels), images))
+
+
+def upload_image(image, host, trace=NULL_TRACE):
+    """
+    Uploads an input image to the ComfyUI server using the /upload/image endpoint
+
+    Returns:
+        str: An error message, or None if the image was uploaded
+    """
+    files = {
+        "image": (image.name, BytesIO(image.blob), image.mime_type),
+        "overwrite": (None, "true"),
+    }
+    try:
+        with trace.span("POST /upload/image", "http", name=image.name):
+            response = requests.post(f"http://{host}/upload/image", files=files)
+    except requests.RequestException as e:
+        return f"Error uploading {image.name}: {str(e)}"
+    if response.status_code != 200:
+        return f"Error uploading {image.name}: {response.text}"
+    return None
+
+
+def upload_prepared_images(prepared, host, uploaded=None, workers=4, trace=NULL_TRACE):
+    """
+    Uploads input images to a ComfyUI backend in parallel
+
+    Images that were already uploaded to the backend with identical content are skipped.
+
+    Args:
+        prepared (list): A list of InputImage objects
+        host (str): The ComfyUI backend
+        uploaded (dict, optional): The digest of the images already on the backend, by name.
+            It is updated with the uploaded images.
+        workers (int, optional): The number of parallel uploads
+        trace (Trace, optional): Records a span for every upload
+
+    Returns:
+        dict: The status, a message and details for every image, like upload_images in rp_handler
+    """
+    if not prepared:
+        return {"status": "success", "message": "No images to upload", "details": []}
+    uploaded = {} if uploaded is None else uploaded
+
+    print(f"runpod-worker-comfy - image(s) upload")
+
+    pending = [image for image in prepared if uploaded.get(image.name) != image.digest]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        errors = dict(zip(pending, executor.map(lambda image: upload_image(image, host, trace), pending)))
+
+    responses = []
+    upload_errors = []
+    for image in prepared:
+        if image not in errors:
+            responses.append(f"Skipped {image.name}, it is already uploaded")
+        elif errors[image]:
+            upload_errors.append(errors[image])
+        else:
+            uploaded[image.name] = image.digest
+            responses.append(f"Successfully uploaded {image.name}")
+
+    if upload_errors:
+        print(f"runpod-worker-comfy - image(s) upload with errors")
+        return {
+            "status": "error",
+            "message": "Some images failed to upload",
+            "details": upload_errors,
+        }
+
+    print(f"runpod-worker-comfy - image(s) upload complete")
+    return {
+        "status": "success",
+        "message": "All images uploaded successfully",
+        "details": responses,
+    }
@@ -1,14 +1,40 @@
-import runpod
-from runpod.serverless.utils import rp_upload
+from startup_profiler import profiler
+import asyncio
 import json
+import math
 import urllib.request
 import urllib.parse
 import time
 import os
+import shlex
+import sqlite3
+import threading
+import uuid
 import requests
 import base64
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from PIL import Image
+from admission import AdmissionController
+from backends import BackendPool, parse_backends
+from coalescer import Coalescer, job_key
+from input_stage import parse_resolutions, prepare_images, upload_prepared_images
+from scheduler import ModelAffinityScheduler
+from supervisor import ComfySupervisor
+from template_stats import PeakVram, TemplateStats
+from tracing import NULL_TRACE, NodeEventListener, Trace, should_trace
+from workflow_binder import (
+    cache_report,
+    cached_nodes,
+    load_output_node_classes,
+    load_template,
+    output_node_hosts,
+    predict_cached,
+    template_name,
+)
+from workflow_graph import WorkflowGraph
+
+# runpod takes seconds to import, it is imported once ComfyUI is starting
+profiler.mark("import rp_handler")
 
 # Time to wait between API check attempts in milliseconds
 COMFY_API_AVAILABLE_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_INTERVAL_MS", 50))
@@ -18,8 +44,45 @@ COMFY_API_AVAILABLE_MAX_RETRIES = int(os.environ.get("COMFY_API_AVAILABLE_MAX_RE
 COMFY_POLLING_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_INTERVAL_MS", 250))
 # Maximum number of poll attempts
 COMFY_POLLING_MAX_RETRIES = int(os.environ.get("COMFY_POLLING_MAX_RETRIES", 500))
+# Resolution the input images of each template are downscaled to, e.g. "workflow=1024x1024"
+COMFY_INPUT_RESOLUTIONS = parse_resolutions(os.environ.get("COMFY_INPUT_RESOLUTIONS", ""))
+# Number of input images that are decoded and uploaded in parallel
+COMFY_UPLOAD_WORKERS = int(os.environ.get("COMFY_UPLOAD_WORKERS", 4))
+# Share of jobs for which a trace is recorded, between 0 and 1; jobs can ask for one with "trace": true
+COMFY_TRACE_SAMPLE_RATE = float(os.environ.get("COMFY_TRACE_SAMPLE_RATE", 0))
+# Directory the traces are written to in the Chrome trace format
+COMFY_TRACE_DIR = os.environ.get("COMFY_TRACE_DIR", "")
+# Seconds a job may take, unless the job sets "deadline_s"; defaults to the polling budget
+COMFY_JOB_DEADLINE_S = float(
+    os.environ.get(
+        "COMFY_JOB_DEADLINE_S", COMFY_POLLING_MAX_RETRIES * COMFY_POLLING_INTERVAL_MS / 1000
+    )
+)
+# SQLite file with the performance of every template, kept across restarts; empty to disable
+COMFY_STATS_PATH = os.environ.get(
+    "COMFY_STATS_PATH",
+    "/runpod-volume/runpod-worker-comfy/stats.sqlite3" if os.path.isdir("/runpod-volume") else "",
+)
+# A template with enough statistics gets this multiple of its p99 execution time as deadline
+COMFY_STATS_DEADLINE_FACTOR = float(os.environ.get("COMFY_STATS_DEADLINE_FACTOR", 3))
 # Host where ComfyUI is running
 COMFY_HOST = os.environ.get("COMFY_HOST", "127.0.0.1:8188")
+# Comma separated list of ComfyUI backends, each "host:port" or "host:port=/output/path"
+COMFY_HOSTS = os.environ.get("COMFY_HOSTS", COMFY_HOST)
+# Time between health checks of the ComfyUI backends in milliseconds
+COMFY_HEALTH_CHECK_INTERVAL_MS = int(os.environ.get("COMFY_HEALTH_CHECK_INTERVAL_MS", 1000))
+# Let the worker start ComfyUI and restart it when it crashes or hangs
+COMFY_SUPERVISE = os.environ.get("COMFY_SUPERVISE", "true").lower() == "true"
+# Command to start ComfyUI, the port and output directory of each backend are appended
+COMFY_COMMAND = os.environ.get(
+    "COMFY_COMMAND",
+    "/workspace/ComfyUI/venv/bin/python /workspace/ComfyUI/main.py --disable-auto-launch --disable-metadata",
+)
+# Seconds ComfyUI may not answer /system_stats before it is considered hung and restarted,
+# and that any other request to ComfyUI may take
+COMFY_HANG_TIMEOUT_S = float(os.environ.get("COMFY_HANG_TIMEOUT_S", 20))
+# Seconds ComfyUI may take to start before it is restarted
+COMFY_STARTUP_TIMEOUT_S = float(os.environ.get("COMFY_STARTUP_TIMEOUT_S", 600))
 # Workflow path
 COMFY_WORKFLOW_PATH = os.environ.get("COMFY_WORKFLOW_PATH", "/workspace/workflow.json")
 # Enforce a clean state after each job is done
@@ -27,6 +90,24 @@ COMFY_WORKFLOW_PATH = os.environ.get("COMFY_WORKFLOW_PATH", "/workspace/workflow
 REFRESH_WORKER = os.environ.get("REFRESH_WORKER", "false").lower() == "true"
 COMFY_OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
 BASE_URL = os.environ.get("BASE_URL", "/workspace/ComfyUI/input/example.png")
+# Maximum number of jobs the worker takes at the same time
+COMFY_CONCURRENCY = int(os.environ.get("COMFY_CONCURRENCY", 1))
+# Seconds a job may be overtaken by jobs using the already loaded models
+COMFY_AFFINITY_STARVATION_S = float(os.environ.get("COMFY_AFFINITY_STARVATION_S", 30))
+
+pool = BackendPool(
+    parse_backends(COMFY_HOSTS, COMFY_OUTPUT_PATH), COMFY_HEALTH_CHECK_INTERVAL_MS / 1000
+)
+scheduler = ModelAffinityScheduler(pool, COMFY_AFFINITY_STARVATION_S)
+admission = AdmissionController(pool, scheduler)
+# The last submitted workflow, new workflows are only processed where they differ
+graph = WorkflowGraph()
+stats = TemplateStats(COMFY_STATS_PATH, COMFY_STATS_DEADLINE_FACTOR) if COMFY_STATS_PATH else None
+# Identical jobs that arrive while one of them is running share its prompt
+coalescer = Coalescer()
+# Decodes the input images of the jobs while they wait for a backend
+image_preparer = ThreadPoolExecutor(max_workers=COMFY_CONCURRENCY)
+supervisors = []
 
 
 # def validate_input(job_input):
@@ -71,6 +152,15 @@ BASE_URL = os.environ.get("BASE_URL", "/workspace/ComfyUI/input/example.png")
 #     return {"workflow": workflow, "images": images}, None
 
 
+def __getattr__(name):
+    # rp_upload is imported with runpod, which is deferred until it is needed
+    if name == "rp_upload":
+        from runpod.serverless.utils import rp_upload
+
+        return rp_upload
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def check_server(url, retries=500, delay=50):
     """
     Check if a server is reachable via HTTP GET request
@@ -105,91 +195,148 @@ def check_server(url, retries=500, delay=50):
     return False
 
 
-def upload_images(images):
+def upload_images(images, host=COMFY_HOST, max_pixels=None, uploaded=None):
     """
     Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
 
+    The images are decoded, downscaled and uploaded in parallel, see input_stage.
+
     Args:
         images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as a base64 encoded string.
-        server_address (str): The address of the ComfyUI server.
+        host (str, optional): The address of the ComfyUI server.
+        max_pixels (int, optional): The number of pixels the workflow works with, larger images are downscaled.
+        uploaded (dict, optional): The digest of the images already on the server, by name.
 
     Returns:
         list: A list of responses from the server for each image upload.
     """
-    if not images:
-        return {"status": "success", "message": "No images to upload", "details": []}
-
-    responses = []
-    upload_errors = []
-
-    print(f"runpod-worker-comfy - image(s) upload")
-
-    for image in images:
-        name = image["name"]
-        image_data = image["image"]
-        blob = base64.b64decode(image_data)
-
-        # Prepare the form data
-        files = {
-            "image": (name, BytesIO(blob), "image/png"),
-            "overwrite": (None, "true"),
-        }
-
-        # POST request to upload the image
-        response = requests.post(f"http://{COMFY_HOST}/upload/image", files=files)
-        if response.status_code != 200:
-            upload_errors.append(f"Error uploading {name}: {response.text}")
-        else:
-            responses.append(f"Successfully uploaded {name}")
-
-    if upload_errors:
-        print(f"runpod-worker-comfy - image(s) upload with errors")
-        return {
-            "status": "error",
-            "message": "Some images failed to upload",
-            "details": upload_errors,
-        }
-
-    print(f"runpod-worker-comfy - image(s) upload complete")
-    return {
-        "status": "success",
-        "message": "All images uploaded successfully",
-        "details": responses,
-    }
+    prepared = prepare_images(images or [], max_pixels, COMFY_UPLOAD_WORKERS)
+    return upload_prepared_images(prepared, host, uploaded, COMFY_UPLOAD_WORKERS)
 
 
-def queue_workflow(workflow):
+def queue_workflow(workflow, host=COMFY_HOST, client_id=None, serialized=None):
     """
     Queue a workflow to be processed by ComfyUI
 
     Args:
         workflow (dict): A dictionary containing the workflow to be processed
+        host (str, optional): The ComfyUI backend to queue the workflow on
+        client_id (str, optional): The websocket client that receives the execution events
+        serialized (str, optional): The workflow already serialized as JSON
 
     Returns:
         dict: The JSON response from ComfyUI after processing the workflow
     """
+    if serialized is None:
+        serialized = json.dumps(workflow)
 
     # The top level element "prompt" is required by ComfyUI
-    data = json.dumps({"prompt": workflow}).encode("utf-8")
+    payload = '{"prompt": ' + serialized
+    if client_id is not None:
+        payload += f', "client_id": {json.dumps(client_id)}'
+    data = (payload + "}").encode("utf-8")
 
-    req = urllib.request.Request(f"http://{COMFY_HOST}/prompt", data=data)
-    return json.loads(urllib.request.urlopen(req).read())
+    req = urllib.request.Request(f"http://{host}/prompt", data=data)
+    return json.loads(urllib.request.urlopen(req, timeout=COMFY_HANG_TIMEOUT_S).read())
 
 
-def get_history(prompt_id):
+def get_history(prompt_id, host=COMFY_HOST):
     """
     Retrieve the history of a given prompt using its ID
 
     Args:
         prompt_id (str): The ID of the prompt whose history is to be retrieved
+        host (str, optional): The ComfyUI backend the prompt was queued on
 
     Returns:
         dict: The history of the prompt, containing all the processing steps and results
     """
-    with urllib.request.urlopen(f"http://{COMFY_HOST}/history/{prompt_id}") as response:
+    with urllib.request.urlopen(
+        f"http://{host}/history/{prompt_id}", timeout=COMFY_HANG_TIMEOUT_S
+    ) as response:
         return json.loads(response.read())
 
 
+def run_workflow(
+    workflow,
+    host=COMFY_HOST,
+    aborted=None,
+    trace=NULL_TRACE,
+    serialized=None,
+    interval_ms=COMFY_POLLING_INTERVAL_MS,
+    max_retries=COMFY_POLLING_MAX_RETRIES,
+    on_poll=None,
+):
+    """
+    Queues a workflow in ComfyUI and polls until it is executed
+
+    Args:
+        workflow (dict): A dictionary containing the workflow to be processed
+        host (str, optional): The ComfyUI backend to run the workflow on
+        aborted (callable, optional): Returns True when ComfyUI was restarted and the
+            prompt is lost, which stops polling right away
+        trace (Trace, optional): Records the HTTP calls and the node executions
+        serialized (str, optional): The workflow already serialized as JSON
+        interval_ms (int, optional): Time to wait between polls in milliseconds
+        max_retries (int, optional): Maximum number of polls
+        on_poll (callable, optional): Called on every poll, e.g. to sample the VRAM
+
+    Returns:
+        tuple: The history entry of the prompt and an error message, if any.
+               The structure is (history, error_message).
+    """
+    client_id = str(uuid.uuid4())
+    listener = NodeEventListener.start(host, client_id, trace, workflow)
+    try:
+        return _run_workflow(
+            workflow, host, aborted, trace, client_id, serialized, interval_ms, max_retries, on_poll
+        )
+    finally:
+        if listener is not None:
+            listener.close()
+
+
+def _run_workflow(
+    workflow, host, aborted, trace, client_id, serialized, interval_ms, max_retries, on_poll
+):
+    # Queue the workflow
+    try:
+        with trace.span("POST /prompt", "http"):
+            queued_workflow = queue_workflow(workflow, host, client_id, serialized)
+        prompt_id = queued_workflow["prompt_id"]
+        print(f"runpod-worker-comfy - queued workflow with ID {prompt_id} on {host}")
+    except Exception as e:
+        return None, f"Error queuing workflow: {str(e)}"
+
+    # Poll for completion
+    print(f"runpod-worker-comfy - wait until image generation is complete")
+    retries = 0
+    try:
+        while retries < max_retries:
+            if aborted is not None and aborted():
+                return None, "ComfyUI was restarted while executing the workflow"
+            if on_poll is not None:
+                on_poll()
+
+            with trace.span("GET /history", "http"):
+                history = get_history(prompt_id, host)
+
+            # Exit the loop if we have found the history
+            if prompt_id in history:
+                if history[prompt_id].get("outputs"):
+                    return history[prompt_id], None
+                else:
+                    return None, "Excusion failed"
+            else:
+                # Wait before trying again
+                time.sleep(interval_ms / 1000)
+                retries += 1
+        else:
+            return None, "Max retries reached while waiting for image generation"
+    except Exception as e:
+        return None, f"Error waiting for image generation: {str(e)}"
+
+
 def base64_encode(img_path):
     """
     Returns base64 encoded image.
@@ -200,6 +347,9 @@ def base64_encode(img_path):
     Returns:
         str: The base64 encoded image
     """
+    # Only needed to encode the output images
+    from PIL import Image
+
     with Image.open(img_path) as img:
         # Convert RGBA/PNG to RGB/JPEG (removes alpha channel if needed)
         if img.mode in ('RGBA', 'LA'):
@@ -213,7 +363,7 @@ def base64_encode(img_path):
         return base64.b64encode(jpg_buffer.getvalue()).decode('utf-8')
 
 
-def process_output_images(outputs, job_id):
+def process_output_images(outputs, job_id, output_path=None, trace=NULL_TRACE):
     """
     This function takes the "outputs" from image generation and the job ID,
     then determines the correct way to return the image, either as a direct URL
@@ -224,6 +374,8 @@ def process_output_images(outputs, job_id):
         outputs (dict): A dictionary containing the outputs from image generation,
                         typically includes node IDs and their respective output data.
         job_id (str): The unique identifier for the job.
+        output_path (str, optional): The output folder of the backend that generated the images.
+        trace (Trace, optional): Records the encoding and upload of the image.
 
     Returns:
         dict: A dictionary with the status ('success' or 'error') and the message,
@@ -252,7 +404,7 @@ def process_output_images(outputs, job_id):
     print(f"runpod-worker-comfy - image generation is done")
 
     # expected image output folder
-    local_image_path = f"{COMFY_OUTPUT_PATH}/{output_images}"
+    local_image_path = f"{output_path or COMFY_OUTPUT_PATH}/{output_images}"
 
     print(f"runpod-worker-comfy - {local_image_path}")
 
@@ -260,13 +412,17 @@ def process_output_images(outputs, job_id):
     if os.path.exists(local_image_path):
         if os.environ.get("BUCKET_ENDPOINT_URL", False):
             # URL to image in AWS S3
-            image = rp_upload.upload_image(job_id, local_image_path)
+            from runpod.serverless.utils import rp_upload
+
+            with trace.span("rp_upload.upload_image"):
+                image = rp_upload.upload_image(job_id, local_image_path)
             print(
                 "runpod-worker-comfy - the image was generated and uploaded to AWS S3"
             )
         else:
             # base64 image
-            image = base64_encode(local_image_path)
+            with trace.span("base64_encode"):
+                image = base64_encode(local_image_path)
             print(
                 "runpod-worker-comfy - the image was generated and converted to base64"
             )
@@ -283,6 +439,46 @@ def process_output_images(outputs, job_id):
         }
 
 
+def output_size(outputs, output_path):
+    """
+    Returns the total size of the output images in bytes
+    """
+    size = 0
+    for node_output in outputs.values():
+        for image in node_output.get("images", []):
+            path = os.path.join(output_path, image["subfolder"], image["filename"])
+            if os.path.exists(path):
+                size += os.path.getsize(path)
+    return size
+
+
+def bind_workflow(job_input):
+    """
+    Returns the workflow to run for the given job input.
+
+    A complete workflow can be sent as "workflow", otherwise the workflow template at
+    COMFY_WORKFLOW_PATH is used with the input image of node 111 set to "url". All
+    other nodes are the shared nodes of the template, so the WorkflowGraph doesn't
+    have to look at them.
+
+    Args:
+        job_input (dict): The input of the job
+
+    Returns:
+        dict: The workflow in ComfyUI API format, to be bound with graph.bind
+    """
+    if job_input.get("workflow"):
+        return job_input["workflow"]
+
+    query = dict(load_template(COMFY_WORKFLOW_PATH, shared=True))
+    node = query["111"]
+    query["111"] = {
+        **node,
+        "inputs": {**node["inputs"], "url_or_path": job_input.get("url", BASE_URL)},
+    }
+    return query
+
+
 def handler(job):
     """
     The main function that handles a job of generating an image.
@@ -296,72 +492,227 @@ def handler(job):
     Returns:
         dict: A dictionary containing either an error message or a success status with generated images.
     """
-    job_input = job["input"].get("url", BASE_URL)
+    cold_start = profiler.first_job()
+    if should_trace(job["input"], COMFY_TRACE_SAMPLE_RATE):
+        trace = Trace(job["id"])
+    else:
+        trace = NULL_TRACE
 
+    with trace.span("handler"):
+        result = run_job(job, trace)
+    if cold_start is not None and "metrics" in result:
+        result["metrics"]["cold_start"] = cold_start
+    if trace is NULL_TRACE:
+        return result
+
+    if COMFY_TRACE_DIR:
+        try:
+            trace_path = trace.write(COMFY_TRACE_DIR)
+            if "metrics" in result:
+                result["metrics"]["trace_path"] = trace_path
+        except OSError as e:
+            print(f"runpod-worker-comfy - could not write the trace: {str(e)}")
+    if job["input"].get("trace"):
+        result["trace"] = trace.to_chrome()
+    return result
+
+
+def load_output_nodes():
+    """
+    Loads the output nodes of every healthy backend they were not loaded from yet,
+    dead nodes are only stripped once they are known
+    """
+    for backend in pool.healthy_backends():
+        if backend.host in output_node_hosts:
+            continue
+        try:
+            load_output_node_classes(backend.host, COMFY_HANG_TIMEOUT_S)
+        except Exception as e:
+            print(f"runpod-worker-comfy - could not load the output nodes of {backend.host}: {str(e)}")
+
+
+def run_job(job, trace=NULL_TRACE):
+    """
+    Runs a job, recording the time spent in each stage in the trace
+    """
     # Make sure that the input is valid
     # validated_data, error_message = validate_input(job_input)
     # if error_message:
     #     return {"error": error_message}
 
-    with open(COMFY_WORKFLOW_PATH, 'r', encoding='utf-8') as file:
-        query = json.load(file)
-    query["111"]["inputs"]["url_or_path"] = job_input
-
+    with trace.span("bind_workflow"):
+        load_output_nodes()
+        try:
+            bound = graph.bind(bind_workflow(job["input"]))
+        except ValueError as e:
+            return {"error": f"Invalid workflow: {str(e)}"}
     validated_data = {
-        "workflow": query
+        "workflow": bound.workflow
     }
 
     # Extract validated data
     workflow = validated_data["workflow"]
-    # images = validated_data.get("images")
+    images = job["input"].get("images")
+    if images is not None and (
+        not isinstance(images, list)
+        or not all(
+            isinstance(image, dict)
+            and isinstance(image.get("name"), str)
+            and isinstance(image.get("image"), str)
+            for image in images
+        )
+    ):
+        return {"error": "'images' must be a list of objects with 'name' and 'image' keys"}
+
+    # Jobs identical to one that is queued or running wait for its outputs
+    key = job_key(bound.serialized, images)
+    started_at = time.monotonic()
+    result, jobs, leader = coalescer.run(key, lambda: execute_job(job, trace, bound, images))
+    if not leader:
+        trace.add("wait_for_identical_job", started_at, time.monotonic())
+    # Coalesced jobs share the result, every job gets its own copy to add to
+    if "metrics" not in result:
+        return dict(result)
+    return {
+        **result,
+        "metrics": {**result["metrics"], "coalesced": not leader, "coalesced_jobs": jobs},
+    }
 
-    # Make sure that the ComfyUI API is available
-    check_server(
-        f"http://{COMFY_HOST}",
-        COMFY_API_AVAILABLE_MAX_RETRIES,
-        COMFY_API_AVAILABLE_INTERVAL_MS,
-    )
 
-    # Upload images if they exist
-    # upload_result = upload_images(images)
+def execute_job(job, trace, bound, images):
+    """
+    Runs the prompt of a job on a ComfyUI backend and returns its outputs
+    """
+    workflow = bound.workflow
+
+    # Reject the job early if it can't finish in time, another worker may be free
+    template = template_name(job["input"], workflow, COMFY_WORKFLOW_PATH, bound.structure)
+    deadline = job["input"].get("deadline_s")
+    if deadline is None and stats is not None:
+        deadline = stats.deadline(template)
+    deadline = float(deadline or COMFY_JOB_DEADLINE_S)
+    interval_ms = COMFY_POLLING_INTERVAL_MS
+    if stats is not None:
+        interval_ms = stats.polling_interval_ms(template, COMFY_POLLING_INTERVAL_MS)
+    with trace.span("admission"):
+        estimate, admitted = admission.admit(template, deadline)
+    if not admitted:
+        print(f"runpod-worker-comfy - rejected job, estimated {estimate:.1f} s")
+        return {
+            "error": f"Job would take an estimated {estimate:.1f} s, the deadline is {deadline:.1f} s",
+            "retryable": True,
+        }
 
-    # if upload_result["status"] == "error":
-    #     return upload_result
+    # Decode and downscale the input images while waiting for a backend
+    def prepare():
+        with trace.span("prepare_images", count=len(images or [])):
+            return prepare_images(
+                images or [], COMFY_INPUT_RESOLUTIONS.get(template), COMFY_UPLOAD_WORKERS
+            )
 
-    # Queue the workflow
-    try:
-        queued_workflow = queue_workflow(workflow)
-        prompt_id = queued_workflow["prompt_id"]
-        print(f"runpod-worker-comfy - queued workflow with ID {prompt_id}")
-    except Exception as e:
-        return {"error": f"Error queuing workflow: {str(e)}"}
+    preparing = image_preparer.submit(prepare)
 
-    # Poll for completion
-    print(f"runpod-worker-comfy - wait until image generation is complete")
-    retries = 0
-    try:
-        while retries < COMFY_POLLING_MAX_RETRIES:
-            history = get_history(prompt_id)
+    models = bound.models
+    signatures = bound.signatures
 
-            # Exit the loop if we have found the history
-            if prompt_id in history:
-                if history[prompt_id].get("outputs"):
-                    break
-                else:
-                    return {"error": "Excusion failed"}
-            else:
-                # Wait before trying again
-                time.sleep(COMFY_POLLING_INTERVAL_MS / 1000)
-                retries += 1
-        else:
-            return {"error": "Max retries reached while waiting for image generation"}
-    except Exception as e:
-        return {"error": f"Error waiting for image generation: {str(e)}"}
+    # Retry on another backend if the one the job was routed to went down
+    for _ in range(len(pool.backends)):
+        # Wait until a backend is free for this job, jobs using the loaded models go first
+        with trace.span("wait_for_backend"):
+            ticket = scheduler.acquire(
+                models,
+                COMFY_API_AVAILABLE_MAX_RETRIES * COMFY_API_AVAILABLE_INTERVAL_MS / 1000,
+            )
+        if ticket is None:
+            # Another worker may have a healthy backend
+            return {"error": "No ComfyUI backend is available", "retryable": True}
+
+        history = None
+        restarts = ticket.backend.restarts
+        predicted = predict_cached(signatures, ticket.backend.signatures)
+        peak_vram = PeakVram(ticket.backend.host) if stats is not None else None
+        try:
+            try:
+                prepared_images = preparing.result()
+            except Exception as e:
+                return {"error": f"Error decoding images: {str(e)}"}
+
+            # Upload images if they exist
+            with trace.span("upload_images", backend=ticket.backend.host):
+                upload_result = upload_prepared_images(
+                    prepared_images,
+                    ticket.backend.host,
+                    ticket.backend.uploads,
+                    COMFY_UPLOAD_WORKERS,
+                    trace,
+                )
+            if upload_result["status"] == "error":
+                return upload_result
+
+            with trace.span("run_workflow", backend=ticket.backend.host):
+                history, error = run_workflow(
+                    workflow,
+                    ticket.backend.host,
+                    lambda: ticket.backend.restarts != restarts,
+                    trace,
+                    bound.serialized,
+                    interval_ms,
+                    math.ceil(deadline * 1000 / interval_ms),
+                    peak_vram.sample if peak_vram is not None else None,
+                )
+            if history:
+                ticket.backend.signatures = signatures
+                admission.record(template, time.monotonic() - ticket.granted_at)
+        finally:
+            execution_time = time.monotonic() - ticket.granted_at
+            scheduler.release(ticket, execution_time if history else None)
+
+        if history or pool.check(ticket.backend):
+            break
+        pool.mark_failed(ticket.backend, drain=True)
+    if error:
+        # The job did not fail because of its input, runpod can send it to another worker
+        retryable = not ticket.backend.healthy or ticket.backend.restarts != restarts
+        return {"error": error, "retryable": retryable}
 
     # Get the generated image and return it as URL in an AWS bucket or as base64
-    images_result = process_output_images(history[prompt_id].get("outputs"), job["id"])
-
-    result = {**images_result, "refresh_worker": REFRESH_WORKER}
+    cached = cached_nodes(history)
+    if stats is not None:
+        try:
+            stats.record(
+                template,
+                execution_time,
+                output_size(history.get("outputs"), ticket.backend.output_path),
+                peak_vram.peak,
+                len([node_id for node_id in cached if node_id in workflow]) / len(workflow),
+            )
+        except (sqlite3.Error, OSError) as e:
+            print(f"runpod-worker-comfy - could not record the template statistics: {str(e)}")
+
+    with trace.span("process_output_images"):
+        images_result = process_output_images(
+            history.get("outputs"), job["id"], ticket.backend.output_path, trace
+        )
+
+    result = {
+        **images_result,
+        "metrics": {
+            **scheduler.metrics(ticket),
+            "template": template,
+            "estimated_s": None if estimate is None else round(estimate, 3),
+            "deadline_s": round(deadline, 3),
+            "polling_interval_ms": round(interval_ms),
+            "comfy_restarts_total": sum(backend.restarts for backend in pool.backends),
+            "cache": cache_report(workflow, predicted, cached),
+            "workflow": {"nodes": len(workflow), "changed": len(bound.changed)},
+            "input_images": {
+                "count": len(prepared_images),
+                "resized": sum(image.resized for image in prepared_images),
+                "bytes": sum(len(image.blob) for image in prepared_images),
+            },
+        },
+        "refresh_worker": REFRESH_WORKER,
+    }
 
     # for filename in os.listdir(COMFY_OUTPUT_PATH):
     #     file_path = os.path.join(COMFY_OUTPUT_PATH, filename)
@@ -371,6 +722,121 @@ def handler(job):
     return result
 
 
+def warmup(backend):
+    """
+    Runs the workflow template once on a backend, so that its models are loaded
+    before the first job arrives
+
+    Args:
+        backend (Backend): The backend that (re)started
+    """
+    try:
+        load_output_node_classes(backend.host, COMFY_HANG_TIMEOUT_S)
+    except Exception as e:
+        print(f"runpod-worker-comfy - could not load the output nodes: {str(e)}")
+
+    if not os.path.exists(COMFY_WORKFLOW_PATH):
+        return
+    bound = graph.bind(bind_workflow({}))
+    with profiler.step(f"warmup {backend.host}"):
+        history, error = run_workflow(
+            bound.workflow, backend.host, serialized=bound.serialized
+        )
+    if error:
+        print(f"runpod-worker-comfy - warmup on {backend.host} failed: {error}")
+        return
+    backend.resident = bound.models
+    backend.signatures = bound.signatures
+    print(f"runpod-worker-comfy - warmup on {backend.host} is finished")
+
+
+def start_supervisors():
+    """
+    Starts and supervises a ComfyUI process for every local backend.
+
+    With several backends, each process only sees the GPU with the index of its backend.
+    """
+    for index, backend in enumerate(pool.backends):
+        hostname, _, port = backend.host.rpartition(":")
+        if hostname not in ("127.0.0.1", "localhost", "0.0.0.0"):
+            continue
+
+        command = shlex.split(COMFY_COMMAND) + [
+            "--port",
+            port,
+            "--output-directory",
+            backend.output_path,
+        ]
+        env = dict(os.environ)
+        if len(pool.backends) > 1:
+            env["CUDA_VISIBLE_DEVICES"] = str(index)
+
+        supervisor = ComfySupervisor(
+            command,
+            backend,
+            pool,
+            env,
+            check_interval=COMFY_HEALTH_CHECK_INTERVAL_MS / 1000,
+            hang_timeout=COMFY_HANG_TIMEOUT_S,
+            startup_timeout=COMFY_STARTUP_TIMEOUT_S,
+            warmup=warmup,
+        )
+        supervisor.start()
+        supervisors.append(supervisor)
+
+
+def load_stats():
+    """
+    Loads the quantiles of every template, which set the default deadlines and polling
+    intervals, and starts the execution time estimates at their median
+
+    It runs in the background while the worker starts, jobs that arrive before it is
+    finished use the configured defaults.
+    """
+    if stats is None:
+        return
+    try:
+        with profiler.step("load template statistics"):
+            summaries = stats.load()
+    except (sqlite3.Error, OSError) as e:
+        print(f"runpod-worker-comfy - could not load the template statistics: {str(e)}")
+        return
+    for template, summary in summaries.items():
+        # Jobs that already finished know better
+        if template not in admission.execution_times:
+            admission.record(template, summary["execution_s"]["p50"])
+    print(f"runpod-worker-comfy - loaded the statistics of {len(summaries)} template(s)")
+
+
+async def async_handler(job):
+    """
+    Runs the handler in a thread, so that runpod can take further jobs concurrently
+    """
+    return await asyncio.to_thread(handler, job)
+
+
+def concurrency_modifier(current_concurrency):
+    """
+    Returns the number of jobs the worker takes at the same time, up to COMFY_CONCURRENCY
+    as long as the backends can finish them within the deadline
+    """
+    return admission.concurrency(COMFY_CONCURRENCY, COMFY_JOB_DEADLINE_S)
+
+
 # Start the handler only if this script is run directly
 if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})
+    if COMFY_SUPERVISE:
+        start_supervisors()
+        profiler.mark("start ComfyUI")
+    # Jobs, admission control and the concurrency find healthy backends from the start
+    pool.start()
+    # The statistics are on the network volume, they must not delay the first job
+    threading.Thread(target=load_stats, daemon=True).start()
+
+    # Imported while ComfyUI is starting
+    import runpod
+
+    profiler.mark("import runpod")
+    runpod.serverless.start(
+        {"handler": async_handler, "concurrency_modifier": concurrency_modifier}
+    )
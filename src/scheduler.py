@@ -0,0 +1,242 @@
+import re
+import threading
+import time
+
+# File extensions of model weights that ComfyUI loaders accept
+MODEL_EXTENSIONS = (".safetensors", ".ckpt", ".pt", ".pth", ".bin", ".gguf", ".sft")
+# Loader inputs that reference a model file, e.g. "ckpt_name", "clip_name1", "lora_name"
+MODEL_INPUT_PATTERN = re.compile(r"^\w*_name\d*$")
+# Weight of the newest sample in the exponentially weighted execution time averages
+EWMA_ALPHA = 0.3
+
+
+def extract_models(workflow):
+    """
+    Returns the set of model files a workflow loads
+
+    Args:
+        workflow (dict): A ComfyUI workflow in API format
+
+    Returns:
+        frozenset: The model file names referenced by the loader nodes of the workflow
+    """
+    models = set()
+    for node in workflow.values():
+        models.update(node_models(node))
+    return frozenset(models)
+
+
+def node_models(node):
+    """
+    Returns the set of model files a single node loads, see extract_models
+    """
+    if not isinstance(node, dict):
+        return frozenset()
+    return frozenset(
+        value
+        for key, value in node.get("inputs", {}).items()
+        if isinstance(value, str)
+        and MODEL_INPUT_PATTERN.match(key)
+        and value.lower().endswith(MODEL_EXTENSIONS)
+    )
+
+
+def ewma(current, sample):
+    """
+    Returns the exponentially weighted average with a new sample, or the sample if
+    there is no average yet
+    """
+    if current is None:
+        return sample
+    return (1 - EWMA_ALPHA) * current + EWMA_ALPHA * sample
+
+
+class Ticket:
+    """
+    A job waiting for, or holding, an execution slot on a ComfyUI backend
+    """
+
+    def __init__(self, models):
+        self.models = models
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self.backend = None
+        self.model_swap = False
+        self.reordered = False
+
+    @property
+    def queue_wait(self):
+        if self.granted_at is None:
+            return time.monotonic() - self.enqueued_at
+        return self.granted_at - self.enqueued_at
+
+
+class ModelAffinityScheduler:
+    """
+    Orders concurrent jobs so that jobs using the models already loaded in ComfyUI run first.
+
+    ComfyUI executes prompts in FIFO order and unloads the weights of the previous
+    prompt whenever the next one needs different models. Instead of queueing every job
+    straight away, jobs wait here until a backend of the pool has a free slot, and a job
+    whose models are resident on a free backend may overtake older jobs. A job that
+    waited longer than the starvation window is always dispatched next, so no model set
+    can be postponed indefinitely.
+    """
+
+    def __init__(self, pool, starvation_window=30.0, slots=1):
+        self.pool = pool
+        self.starvation_window = starvation_window
+        self.slots = slots
+        self.swaps = 0
+        self.swaps_avoided = 0
+        self._waiting = []
+        self._cond = threading.Condition()
+        # Average execution time of jobs that did and did not have to swap models
+        self._swap_time = None
+        self._warm_time = None
+        pool.on_healthy.append(self.wake)
+
+    @property
+    def waiting(self):
+        """
+        Number of jobs waiting for a backend
+        """
+        return len(self._waiting)
+
+    def _free_backends(self):
+        return [
+            backend
+            for backend in self.pool.healthy_backends()
+            if backend.in_flight < self.slots
+        ]
+
+    @staticmethod
+    def _needs_swap(models, backends):
+        return all(backend.needs_swap(models) for backend in backends)
+
+    def acquire(self, models, timeout=None):
+        """
+        Blocks until the job is allowed to queue its workflow on a backend
+
+        Args:
+            models (frozenset): The model set of the job, see extract_models
+            timeout (float, optional): Seconds to wait while no backend is healthy. Waiting
+                for a busy backend is not limited, admission control covers that.
+
+        Returns:
+            Ticket: The ticket that has to be passed to release once the job is executed,
+                    or None if no backend became healthy within the timeout
+        """
+        ticket = Ticket(models)
+        unhealthy_since = None
+        with self._cond:
+            self._waiting.append(ticket)
+            self._dispatch()
+            while ticket.granted_at is None:
+                now = time.monotonic()
+                if self.pool.healthy_backends():
+                    unhealthy_since = None
+                elif unhealthy_since is None:
+                    unhealthy_since = now
+                elif timeout is not None and now - unhealthy_since >= timeout:
+                    self._waiting.remove(ticket)
+                    return None
+                # Wake up regularly, backends may have become healthy in the meantime
+                self._cond.wait(0.5)
+                self._dispatch()
+        return ticket
+
+    def wake(self, backend=None):
+        """
+        Dispatches the waiting jobs, e.g. when a backend became healthy
+        """
+        with self._cond:
+            self._dispatch()
+
+    def release(self, ticket, execution_time=None):
+        """
+        Frees the slot of a job and dispatches the next one
+
+        Args:
+            ticket (Ticket): The ticket returned by acquire
+            execution_time (float, optional): Seconds ComfyUI spent executing the job,
+                used to estimate the cost of a model swap
+        """
+        with self._cond:
+            if execution_time is not None and ticket.models:
+                if ticket.model_swap:
+                    self._swap_time = ewma(self._swap_time, execution_time)
+                else:
+                    self._warm_time = ewma(self._warm_time, execution_time)
+            ticket.backend.in_flight -= 1
+            self._dispatch()
+
+    @property
+    def swap_cost(self):
+        """
+        Estimated seconds a model swap adds to the execution of a job
+        """
+        if self._swap_time is None or self._warm_time is None:
+            return 0.0
+        return max(0.0, self._swap_time - self._warm_time)
+
+    def next_ticket(self, now=None):
+        """
+        Returns the waiting ticket that should be dispatched next, without removing it
+        """
+        backends = self._free_backends()
+        if not self._waiting or not backends:
+            return None
+        now = time.monotonic() if now is None else now
+        oldest = self._waiting[0]
+        if now - oldest.enqueued_at >= self.starvation_window:
+            return oldest
+        if self._needs_swap(oldest.models, backends):
+            for ticket in self._waiting[1:]:
+                if ticket.models and not self._needs_swap(ticket.models, backends):
+                    return ticket
+        return oldest
+
+    def _dispatch(self):
+        while True:
+            ticket = self.next_ticket()
+            if ticket is None:
+                break
+            backend = self.pool.select(ticket.models, self.slots)
+            if backend is None:
+                # The health checks drained a backend in the meantime, the ticket
+                # keeps its place until the next dispatch
+                break
+            oldest = self._waiting[0]
+            if ticket is not oldest and self._needs_swap(
+                oldest.models, self._free_backends()
+            ):
+                ticket.reordered = True
+                self.swaps_avoided += 1
+            self._waiting.remove(ticket)
+
+            ticket.backend = backend
+            ticket.model_swap = backend.needs_swap(ticket.models)
+            if ticket.model_swap:
+                self.swaps += 1
+            if ticket.models and not ticket.models <= backend.resident:
+                backend.resident = ticket.models
+
+            ticket.granted_at = time.monotonic()
+            backend.in_flight += 1
+        self._cond.notify_all()
+
+    def metrics(self, ticket):
+        """
+        Returns the scheduling metrics of a job, to be included in its output
+        """
+        with self._cond:
+            return {
+                "backend": ticket.backend.host,
+                "queue_wait_s": round(ticket.queue_wait, 3),
+                "model_swap": ticket.model_swap,
+                "reordered": ticket.reordered,
+                "model_swaps_total": self.swaps,
+                "model_swaps_avoided_total": self.swaps_avoided,
+                "time_saved_s_total": round(self.swaps_avoided * self.swap_cost, 3),
+            }
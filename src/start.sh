@@ -1,32 +1,59 @@
 #!/usr/bin/env bash
 
+# The handler reports how long the cold start took, broken down by step
+export WORKER_STARTED_AT="$(date +%s.%N)"
+export WORKER_STARTUP_STEPS="/tmp/startup_steps.tsv"
+: > "$WORKER_STARTUP_STEPS"
+
+# Runs a command and records how long it took
+step() {
+    local name="$1"
+    shift
+    local start
+    start="$(date +%s.%N)"
+    "$@"
+    printf '%s\t%s\t%s\n' "$name" "$start" "$(date +%s.%N)" >> "$WORKER_STARTUP_STEPS"
+}
+
+find_tcmalloc() {
+    TCMALLOC="$(ldconfig -p | grep -Po "libtcmalloc.so.\d" | head -n 1)"
+}
+
+huggingface_login() {
+    git config --global credential.helper store
+    if command -v /workspace/ComfyUI/venv/bin/huggingface-cli >/dev/null 2>&1; then
+        /workspace/ComfyUI/venv/bin/huggingface-cli login --token "$HUGGINGFACE_TOKEN" --add-to-git-credential
+    else
+        echo "huggingface-cli not found. Skipping."
+    fi
+}
+
 # Use libtcmalloc for better memory management
-TCMALLOC="$(ldconfig -p | grep -Po "libtcmalloc.so.\d" | head -n 1)"
+step "tcmalloc lookup" find_tcmalloc
 export LD_PRELOAD="${TCMALLOC}"
-ln -s /runpod-volume /workspace
+step "symlink /workspace" ln -s /runpod-volume /workspace
 
 mkdir -p "$COMFY_OUTPUT_PATH"
 
-git config --global credential.helper store
-if command -v /workspace/ComfyUI/venv/bin/huggingface-cli >/dev/null 2>&1; then
-    /workspace/ComfyUI/venv/bin/huggingface-cli login --token "$HUGGINGFACE_TOKEN" --add-to-git-credential
-else
-    echo "huggingface-cli not found. Skipping."
-fi
+# The login is only needed for downloads, so it doesn't hold up ComfyUI
+step "huggingface-cli login" huggingface_login &
+
+COMFY_COMMAND="/workspace/ComfyUI/venv/bin/python /workspace/ComfyUI/main.py --disable-auto-launch --disable-metadata"
+RP_HANDLER_ARGS=""
 
 # Serve the API and don't shutdown the container
 if [ "$SERVE_API_LOCALLY" == "true" ]; then
-    echo "runpod-worker-comfy: Starting ComfyUI"
-    /workspace/ComfyUI/venv/bin/python /workspace/ComfyUI/main.py --disable-auto-launch --disable-metadata --listen --output-directory "$COMFY_OUTPUT_PATH" &
-    python3 /init.py &
+    COMFY_COMMAND="$COMFY_COMMAND --listen"
+    RP_HANDLER_ARGS="--rp_serve_api --rp_api_host=0.0.0.0"
+fi
+export COMFY_COMMAND
 
-    echo "runpod-worker-comfy: Starting RunPod Handler"
-    python3 -u /rp_handler.py --rp_serve_api --rp_api_host=0.0.0.0
-else
+# By default the handler starts ComfyUI itself and restarts it when it crashes
+if [ "$COMFY_SUPERVISE" == "false" ]; then
     echo "runpod-worker-comfy: Starting ComfyUI"
-    /workspace/ComfyUI/venv/bin/python /workspace/ComfyUI/main.py --disable-auto-launch --disable-metadata --output-directory "$COMFY_OUTPUT_PATH" &
+    $COMFY_COMMAND --output-directory "$COMFY_OUTPUT_PATH" &
     python3 /init.py &
+fi
 
-    echo "runpod-worker-comfy: Starting RunPod Handler"
-    python3 -u /rp_handler.py
-fi
\ No newline at end of file
+echo "runpod-worker-comfy: Starting RunPod Handler"
+python3 -u /rp_handler.py $RP_HANDLER_ARGS
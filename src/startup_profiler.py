@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StartupProfiler:
+    """
+    Records the wall time from the start of the container to the first job, broken
+    down by step.
+
+    start.sh exports WORKER_STARTED_AT and appends its own steps to the file at
+    WORKER_STARTUP_STEPS as "name<TAB>start<TAB>end" lines, in seconds since the epoch.
+    """
+
+    def __init__(self, started_at=None, steps_path=None):
+        now = time.time()
+        self.started_at = now if started_at is None else started_at
+        self.steps_path = steps_path
+        self.steps = []
+        self.first_job_at = None
+        self._last = now
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        started_at = os.environ.get("WORKER_STARTED_AT")
+        return cls(
+            float(started_at) if started_at else None,
+            os.environ.get("WORKER_STARTUP_STEPS"),
+        )
+
+    def add(self, name, start, end):
+        """
+        Adds a step, start and end are time.time() values
+        """
+        with self._lock:
+            self.steps.append((name, start, end))
+
+    def mark(self, name):
+        """
+        Adds a step that lasted from the previous mark until now
+        """
+        now = time.time()
+        self.add(name, self._last, now)
+        self._last = now
+
+    @contextmanager
+    def step(self, name):
+        """
+        Records the code in the with block as a step
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time())
+
+    def load_shell_steps(self):
+        """
+        Adds the steps that start.sh recorded
+        """
+        if not self.steps_path or not os.path.exists(self.steps_path):
+            return
+        with open(self.steps_path, encoding="utf-8") as file:
+            for line in file:
+                name, _, times = line.rstrip("\n").partition("\t")
+                start, _, end = times.partition("\t")
+                try:
+                    self.add(f"start.sh: {name}", float(start), float(end))
+                except ValueError:
+                    continue
+
+    def first_job(self):
+        """
+        Records that the first job was accepted
+
+        Returns:
+            dict: The startup report for the first job, None for any later job
+        """
+        with self._lock:
+            if self.first_job_at is not None:
+                return None
+            self.first_job_at = time.time()
+        self.load_shell_steps()
+        report = self.report()
+        print(f"runpod-worker-comfy - cold start: {json.dumps(report)}")
+        return report
+
+    def report(self):
+        """
+        Returns:
+            dict: The total time to the first job and every step, in seconds since
+            the start of the container
+        """
+        with self._lock:
+            steps = sorted(self.steps, key=lambda step: step[1])
+        first_job_at = self.first_job_at if self.first_job_at is not None else time.time()
+        return {
+            "to_first_job_s": round(first_job_at - self.started_at, 3),
+            "steps": [
+                {
+                    "name": name,
+                    "start_s": round(step_start - self.started_at, 3),
+                    "duration_s": round(step_end - step_start, 3),
+                }
+                for name, step_start, step_end in steps
+            ],
+        }
+
+
+profiler = StartupProfiler.from_env()
@@ -0,0 +1,132 @@
+import subprocess
+import threading
+import time
+import urllib.request
+
+
+class ComfySupervisor:
+    """
+    Owns a ComfyUI process and restarts it when it dies or hangs.
+
+    A background thread checks the process every check_interval seconds. ComfyUI is
+    restarted when the process exited, or when /system_stats did not answer for
+    hang_timeout seconds (startup_timeout while it is still starting). On a restart the
+    backend is drained and its restart counter is increased, which makes jobs that are
+    in flight on it fail fast. Once ComfyUI answers again, the warmup callback is run in its own thread.
+    """
+
+    def __init__(
+        self,
+        command,
+        backend,
+        pool=None,
+        env=None,
+        check_interval=1.0,
+        hang_timeout=20.0,
+        startup_timeout=600.0,
+        warmup=None,
+    ):
+        self.command = command
+        self.backend = backend
+        self.pool = pool
+        self.env = env
+        self.check_interval = check_interval
+        self.hang_timeout = hang_timeout
+        self.startup_timeout = startup_timeout
+        self.warmup = warmup
+        self.process = None
+        self.ready = False
+        self._started_at = None
+        self._last_seen_at = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Launches ComfyUI and starts watching it
+        """
+        self._launch()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops watching ComfyUI and terminates it
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._terminate()
+
+    def _launch(self):
+        print(f"runpod-worker-comfy - starting ComfyUI on {self.backend.host}")
+        self.process = subprocess.Popen(self.command, env=self.env)
+        self.ready = False
+        self._started_at = time.monotonic()
+        self._last_seen_at = None
+
+    def _terminate(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def _responds(self):
+        try:
+            with urllib.request.urlopen(
+                f"{self.backend.url}/system_stats", timeout=self.hang_timeout
+            ) as response:
+                return response.status == 200
+        except Exception:
+            return False
+
+    def check(self):
+        """
+        Checks ComfyUI once and restarts it if it exited or hangs
+        """
+        exit_code = self.process.poll()
+        if exit_code is not None:
+            self.restart(f"exited with code {exit_code}")
+        elif self._responds():
+            self._last_seen_at = time.monotonic()
+            if not self.ready:
+                self.ready = True
+                print(f"runpod-worker-comfy - ComfyUI on {self.backend.host} is ready")
+                if self.warmup is not None:
+                    # The warmup runs a prompt, ComfyUI must be watched meanwhile
+                    threading.Thread(target=self._warmup, daemon=True).start()
+        elif self.ready:
+            if time.monotonic() - self._last_seen_at > self.hang_timeout:
+                self.restart(f"did not answer for {self.hang_timeout} s")
+        elif time.monotonic() - self._started_at > self.startup_timeout:
+            self.restart(f"did not start within {self.startup_timeout} s")
+
+    def _warmup(self):
+        try:
+            self.warmup(self.backend)
+        except Exception as e:
+            print(f"runpod-worker-comfy - warmup of {self.backend.host} failed: {str(e)}")
+
+    def restart(self, reason):
+        """
+        Kills ComfyUI, drains its backend and launches it again
+        """
+        print(f"runpod-worker-comfy - ComfyUI on {self.backend.host} {reason}, restarting")
+        self.backend.restarts += 1
+        if self.pool is not None:
+            self.pool.mark_failed(self.backend, drain=True)
+        self.backend.resident = frozenset()
+        self.backend.signatures = {}
+        self._terminate()
+        self._launch()
+
+    def _run(self):
+        while not self._stopped.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                print(f"runpod-worker-comfy - supervisor error: {str(e)}")
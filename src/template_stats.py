@@ -0,0 +1,228 @@
+import argparse
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+# Samples kept per template, older ones are removed when the store is loaded
+MAX_SAMPLES = 1000
+# Samples a template needs before its quantiles replace the configured defaults
+MIN_SAMPLES = 10
+# Quantiles reported for every metric
+QUANTILES = (0.5, 0.9, 0.99)
+# Number of polls during a typical execution, the polling interval follows from it
+POLLS_PER_EXECUTION = 50
+# Longest interval between two polls of the history in milliseconds
+MAX_POLLING_INTERVAL_MS = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    template TEXT NOT NULL,
+    finished_at REAL NOT NULL,
+    execution_s REAL NOT NULL,
+    output_bytes INTEGER NOT NULL,
+    peak_vram_bytes INTEGER,
+    cache_hit_rate REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_template ON jobs (template, finished_at);
+"""
+METRICS = ("execution_s", "output_bytes", "peak_vram_bytes", "cache_hit_rate")
+
+
+def vram_used(host):
+    """
+    Returns the VRAM in use on the GPUs of a ComfyUI backend in bytes, from /system_stats
+    """
+    response = requests.get(f"http://{host}/system_stats", timeout=2)
+    devices = response.json().get("devices", [])
+    return sum(device["vram_total"] - device["vram_free"] for device in devices)
+
+
+class PeakVram:
+    """
+    Keeps the highest VRAM usage of a backend while a job runs, sampled on every poll
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.peak = None
+
+    def sample(self):
+        try:
+            used = vram_used(self.host)
+        except (requests.RequestException, ValueError, KeyError):
+            return
+        self.peak = used if self.peak is None else max(self.peak, used)
+
+
+def quantile(values, q):
+    """
+    Returns the q-quantile of sorted values, interpolating between the closest ranks
+    """
+    position = (len(values) - 1) * q
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class TemplateStats:
+    """
+    Stores the performance of every job per template in a SQLite database, usually
+    on the network volume, so that it survives restarts of the worker.
+
+    Jobs are only appended, the quantiles are summarized when the store is loaded.
+    """
+
+    def __init__(self, path, deadline_factor=3.0):
+        self.path = path
+        self.deadline_factor = deadline_factor
+        # Quantiles by template, as of the last load
+        self.summaries = {}
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def load(self, prune=True):
+        """
+        Summarizes the quantiles of every template
+
+        Args:
+            prune (bool, optional): Remove all but the MAX_SAMPLES latest jobs of every template first
+
+        Returns:
+            dict: The quantiles by template, see summarize
+        """
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                if prune:
+                    connection.execute(
+                        """
+                        DELETE FROM jobs WHERE rowid IN (
+                            SELECT rowid FROM (
+                                SELECT rowid, ROW_NUMBER() OVER (
+                                    PARTITION BY template ORDER BY finished_at DESC
+                                ) AS age FROM jobs
+                            ) WHERE age > ?
+                        )
+                        """,
+                        (MAX_SAMPLES,),
+                    )
+            rows = connection.execute(
+                f"SELECT template, {', '.join(METRICS)} FROM jobs ORDER BY finished_at"
+            ).fetchall()
+
+        samples = {}
+        for template, *values in rows:
+            samples.setdefault(template, []).append(values)
+        self.summaries = {
+            template: summarize(values) for template, values in samples.items()
+        }
+        return self.summaries
+
+    def record(self, template, execution_s, output_bytes, peak_vram_bytes, cache_hit_rate):
+        """
+        Appends a finished job of the template
+        """
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute(
+                    f"INSERT INTO jobs (template, finished_at, {', '.join(METRICS)}) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (template, time.time(), execution_s, output_bytes, peak_vram_bytes, cache_hit_rate),
+                )
+
+    def _execution_quantile(self, template, q):
+        summary = self.summaries.get(template)
+        if summary is None or summary["samples"] < MIN_SAMPLES:
+            return None
+        return summary["execution_s"][f"p{round(q * 100)}"]
+
+    def deadline(self, template):
+        """
+        Returns the seconds a job of the template may take, a multiple of the p99
+        execution time, or None without enough samples
+        """
+        p99 = self._execution_quantile(template, 0.99)
+        return None if p99 is None else self.deadline_factor * p99
+
+    def polling_interval_ms(self, template, minimum):
+        """
+        Returns the interval between polls of the history for a job of the template
+
+        Short jobs are polled every minimum milliseconds, long jobs less often, so that
+        polling adds about 1 % to the median execution time.
+        """
+        p50 = self._execution_quantile(template, 0.5)
+        if p50 is None:
+            return minimum
+        return max(minimum, min(MAX_POLLING_INTERVAL_MS, p50 * 1000 / POLLS_PER_EXECUTION))
+
+
+def summarize(samples):
+    """
+    Returns the quantiles of every metric
+
+    Args:
+        samples (list): The values of METRICS for every job
+
+    Returns:
+        dict: The number of samples, and e.g. {"p50": ..., "p90": ..., "p99": ...} per metric
+    """
+    summary = {"samples": len(samples)}
+    for index, metric in enumerate(METRICS):
+        values = sorted(sample[index] for sample in samples if sample[index] is not None)
+        summary[metric] = (
+            {f"p{round(q * 100)}": round(quantile(values, q), 3) for q in QUANTILES}
+            if values
+            else None
+        )
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reports the quantiles of every template")
+    parser.add_argument(
+        "--path",
+        default=os.environ.get("COMFY_STATS_PATH", "/runpod-volume/runpod-worker-comfy/stats.sqlite3"),
+    )
+    parser.add_argument("--template", help="Only report this template")
+    parser.add_argument("--json", action="store_true", help="Print the quantiles as JSON")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        parser.exit(1, f"{args.path} does not exist\n")
+    summaries = TemplateStats(args.path).load(prune=False)
+    if args.template:
+        summaries = {args.template: summaries[args.template]} if args.template in summaries else {}
+
+    if args.json:
+        print(json.dumps(summaries, indent=2))
+        return
+    print(f"{'template':<24} {'jobs':>6} {'metric':<16} {'p50':>14} {'p90':>14} {'p99':>14}")
+    for template, summary in sorted(summaries.items()):
+        for metric in METRICS:
+            quantiles = summary[metric]
+            if quantiles is None:
+                continue
+            print(
+                f"{template:<24} {summary['samples']:>6} {metric:<16} "
+                + " ".join(f"{quantiles[f'p{round(q * 100)}']:>14,.3f}" for q in QUANTILES)
+            )
+
+
+if __name__ == "__main__":
+    main()
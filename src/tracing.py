@@ -0,0 +1,199 @@
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import websocket
+except ImportError:
+    # Without websocket-client the trace has no spans for the ComfyUI nodes
+    websocket = None
+
+# Thread id of the lane that shows the node executions in ComfyUI
+COMFY_TID = 0
+# Seconds to wait for the websocket of ComfyUI to connect
+WEBSOCKET_TIMEOUT_S = 5
+
+
+def should_trace(job_input, sample_rate):
+    """
+    Returns True if a trace should be recorded for the job
+
+    Args:
+        job_input (dict): The input of the job, "trace": true always records a trace
+        sample_rate (float): The share of jobs that are traced, between 0 and 1
+    """
+    return bool(job_input.get("trace")) or random.random() < sample_rate
+
+
+class Trace:
+    """
+    Records the spans of a job and exports them in the Chrome trace format,
+    which can be opened in chrome://tracing or https://ui.perfetto.dev
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.origin = time.monotonic()
+        self.events = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, end, category="worker", tid=None, args=None):
+        """
+        Adds a span, start and end are time.monotonic() values
+        """
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((start - self.origin) * 1e6),
+            "dur": round((end - start) * 1e6),
+            "pid": 1,
+            "tid": threading.get_native_id() if tid is None else tid,
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category="worker", **args):
+        """
+        Records the code in the with block as a span
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.monotonic(), category, args=args)
+
+    def to_chrome(self):
+        """
+        Returns the trace as a dictionary in the Chrome trace format
+        """
+        with self._lock:
+            events = list(self.events)
+        metadata = [
+            {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": f"job {self.job_id}"}},
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": COMFY_TID, "args": {"name": "ComfyUI"}},
+        ]
+        return {"traceEvents": metadata + events, "displayTimeUnit": "ms"}
+
+    def write(self, directory):
+        """
+        Writes the trace to <directory>/<job id>.trace.json
+
+        Returns:
+            str: The path of the trace file
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.job_id}.trace.json")
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_chrome(), file)
+        return path
+
+
+class NullTrace:
+    """
+    A trace that records nothing, for jobs that are not sampled
+    """
+
+    events = []
+
+    def add(self, *args, **kwargs):
+        pass
+
+    @contextmanager
+    def span(self, *args, **kwargs):
+        yield
+
+
+NULL_TRACE = NullTrace()
+
+
+class NodeEventListener:
+    """
+    Listens to the websocket of ComfyUI and records a span for every node execution.
+
+    ComfyUI sends an "executing" event when it starts a node, and one with node None
+    when the prompt is done, so a node runs until the next "executing" event.
+    """
+
+    def __init__(self, host, client_id, trace, workflow):
+        self.trace = trace
+        self.workflow = workflow
+        self._ws = websocket.create_connection(
+            f"ws://{host}/ws?clientId={client_id}", timeout=WEBSOCKET_TIMEOUT_S
+        )
+        # Block in recv until the prompt is done, close() ends it early
+        self._ws.settimeout(None)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def start(cls, host, client_id, trace, workflow):
+        """
+        Returns a listener, or None if it can't connect or websocket-client is missing
+        """
+        if websocket is None or isinstance(trace, NullTrace):
+            return None
+        try:
+            return cls(host, client_id, trace, workflow)
+        except Exception as e:
+            print(f"runpod-worker-comfy - could not connect to the websocket: {str(e)}")
+            return None
+
+    def _node_name(self, node_id):
+        node = self.workflow.get(node_id, {})
+        return f"{node.get('class_type', 'node')} #{node_id}"
+
+    def _run(self):
+        current = None
+        while True:
+            try:
+                message = self._ws.recv()
+            except Exception:
+                break
+            # Binary messages are previews
+            if not isinstance(message, str):
+                continue
+            event = json.loads(message)
+            event_type, data = event.get("type"), event.get("data", {})
+            now = time.monotonic()
+
+            if event_type == "executing":
+                if current is not None:
+                    self.trace.add(
+                        self._node_name(current[0]), current[1], now, "comfyui", COMFY_TID
+                    )
+                current = (data["node"], now) if data.get("node") is not None else None
+                if current is None:
+                    break
+            elif event_type == "execution_cached":
+                for node_id in data.get("nodes", []):
+                    self.trace.add(
+                        f"{self._node_name(node_id)} (cached)", now, now, "comfyui", COMFY_TID
+                    )
+            elif event_type in ("execution_error", "execution_interrupted"):
+                if current is not None:
+                    self.trace.add(
+                        self._node_name(current[0]),
+                        current[1],
+                        now,
+                        "comfyui",
+                        COMFY_TID,
+                        {"error": event_type},
+                    )
+                break
+
+    def close(self):
+        """
+        Waits briefly for the last events and closes the websocket
+        """
+        self._thread.join(1)
+        try:
+            self._ws.close()
+        except Exception:
+            pass
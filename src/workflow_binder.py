@@ -0,0 +1,294 @@
+import copy
+import hashlib
+import json
+import os
+import urllib.request
+
+# Core ComfyUI nodes that produce outputs, extended with the output nodes that
+# /object_info reports, see load_output_node_classes
+output_node_classes = {
+    "SaveImage",
+    "PreviewImage",
+    "SaveAnimatedWEBP",
+    "SaveAnimatedPNG",
+    "SaveLatent",
+    "Image Save",
+}
+# Backends whose output nodes were added to output_node_classes. Until there is one,
+# the output nodes of custom nodes are unknown and no node is stripped
+output_node_hosts = set()
+
+_templates = {}
+
+
+def load_template(path, shared=False):
+    """
+    Returns a copy of the workflow template at the given path
+
+    The template is only parsed again when the file changed, so every job is bound
+    to the exact same graph.
+
+    Args:
+        path (str): The path to the workflow template in API format
+        shared (bool, optional): Return the cached template itself, which must not be
+            modified, so that its nodes are the same objects for every job
+
+    Returns:
+        dict: A copy of the template that can be modified
+    """
+    mtime = os.path.getmtime(path)
+    cached = _templates.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, "r", encoding="utf-8") as file:
+            cached = (mtime, canonicalize(json.load(file)))
+        _templates[path] = cached
+    return cached[1] if shared else copy.deepcopy(cached[1])
+
+
+def template_name(job_input, workflow, template_path, structure=None):
+    """
+    Returns the name under which statistics of a job's workflow are collected
+
+    Jobs bound to the template are named after the template file. Inline workflows
+    are named after their graph structure, so jobs that only differ in input values
+    share a name.
+
+    Args:
+        job_input (dict): The input of the job
+        workflow (dict): The bound workflow of the job
+        template_path (str): The path to the workflow template
+        structure (str, optional): The structure_id of the workflow, if it is known
+
+    Returns:
+        str: The template name
+    """
+    if not job_input.get("workflow"):
+        return os.path.splitext(os.path.basename(template_path))[0]
+    return f"inline-{structure or structure_id(workflow)}"
+
+
+def structure_id(workflow):
+    """
+    Returns a short hash of the node ids and classes of a workflow, ignoring input values
+    """
+    structure = json.dumps(
+        sorted((node_id, node["class_type"]) for node_id, node in workflow.items())
+    )
+    return hashlib.sha1(structure.encode("utf-8")).hexdigest()[:8]
+
+
+def load_output_node_classes(host, timeout=20):
+    """
+    Adds the output nodes that a ComfyUI backend knows about to output_node_classes
+
+    Args:
+        host (str): The ComfyUI backend to ask
+        timeout (float, optional): Seconds the backend may take to answer
+    """
+    with urllib.request.urlopen(f"http://{host}/object_info", timeout=timeout) as response:
+        object_info = json.loads(response.read())
+    output_node_classes.update(
+        name for name, info in object_info.items() if info.get("output_node")
+    )
+    output_node_hosts.add(host)
+
+
+def is_link(value):
+    """
+    Returns True if an input value references the output of another node
+    """
+    return (
+        isinstance(value, list)
+        and len(value) == 2
+        and isinstance(value[0], (str, int))
+        and isinstance(value[1], int)
+    )
+
+
+def _canonical_value(value):
+    if is_link(value):
+        return [str(value[0]), value[1]]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, list):
+        return [_canonical_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _canonical_value(value[key]) for key in sorted(value)}
+    return value
+
+
+def canonicalize(workflow):
+    """
+    Returns the workflow with canonical node ids and input values
+
+    ComfyUI only reuses the result of a node if the node id and its inputs are the
+    same as in the previous prompt. Node ids and links are normalized to strings,
+    integral floats to ints, inputs are sorted and the UI-only "_meta" is dropped, so
+    equivalent workflows are sent in exactly the same form.
+
+    Args:
+        workflow (dict): A ComfyUI workflow in API format
+
+    Returns:
+        dict: The canonical workflow
+    """
+    return {
+        str(node_id): canonicalize_node(node)
+        for node_id, node in sorted(workflow.items(), key=lambda item: node_sort_key(item[0]))
+    }
+
+
+def canonicalize_node(node):
+    """
+    Returns a node with canonical input values and without "_meta", see canonicalize
+    """
+    return {
+        "inputs": _canonical_value(node.get("inputs", {})),
+        "class_type": node["class_type"],
+    }
+
+
+def node_sort_key(node_id):
+    """
+    Sorts numeric node ids by their value, before all other ids
+    """
+    node_id = str(node_id)
+    return (0, int(node_id), "") if node_id.isdigit() else (1, 0, node_id)
+
+
+def strip_dead_nodes(workflow):
+    """
+    Removes the nodes that no output node depends on
+
+    Args:
+        workflow (dict): A canonical ComfyUI workflow
+
+    Returns:
+        dict: The workflow without dead nodes, or the workflow itself if it has no known
+        output node or the output nodes were not loaded yet
+    """
+    if not output_node_hosts:
+        return workflow
+    outputs = [
+        node_id
+        for node_id, node in workflow.items()
+        if node["class_type"] in output_node_classes
+    ]
+    if not outputs:
+        return workflow
+
+    reachable = set()
+    pending = list(outputs)
+    while pending:
+        node_id = pending.pop()
+        if node_id in reachable or node_id not in workflow:
+            continue
+        reachable.add(node_id)
+        for value in workflow[node_id]["inputs"].values():
+            if is_link(value):
+                pending.append(value[0])
+
+    return {node_id: node for node_id, node in workflow.items() if node_id in reachable}
+
+
+def prepare_workflow(workflow):
+    """
+    Returns the canonical workflow without dead nodes, ready to be queued
+    """
+    return strip_dead_nodes(canonicalize(workflow))
+
+
+def node_signatures(workflow, known=None):
+    """
+    Returns a signature for every node that covers its inputs and all its ancestors
+
+    Two nodes with the same id and signature produce the same result, so ComfyUI can
+    take it from its cache.
+
+    Args:
+        workflow (dict): A canonical ComfyUI workflow
+        known (dict, optional): Signatures of nodes that are still valid, they are
+            not computed again
+
+    Returns:
+        dict: The signature of every node, by node id
+    """
+    signatures = dict(known or {})
+
+    def signature(node_id, path=()):
+        if node_id in signatures:
+            return signatures[node_id]
+        node = workflow.get(node_id)
+        if node is None or node_id in path:
+            return None
+        inputs = {
+            key: ["link", signature(value[0], path + (node_id,)), value[1]]
+            if is_link(value)
+            else value
+            for key, value in node["inputs"].items()
+        }
+        data = json.dumps([node["class_type"], inputs], sort_keys=True)
+        signatures[node_id] = hashlib.sha1(data.encode("utf-8")).hexdigest()
+        return signatures[node_id]
+
+    for node_id in workflow:
+        signature(node_id)
+    return signatures
+
+
+def predict_cached(signatures, previous):
+    """
+    Returns the ids of the nodes ComfyUI should take from its cache
+
+    Args:
+        signatures (dict): The node signatures of the workflow to queue
+        previous (dict): The node signatures of the previous workflow on the same backend
+
+    Returns:
+        list: The ids of the nodes that did not change since the previous workflow
+    """
+    return [
+        node_id
+        for node_id, signature in signatures.items()
+        if previous.get(node_id) == signature
+    ]
+
+
+def cached_nodes(history):
+    """
+    Returns the ids of the nodes ComfyUI took from its cache
+
+    ComfyUI sends them with the "execution_cached" websocket event and also records
+    the event in the status messages of the history.
+
+    Args:
+        history (dict): The history entry of a prompt
+
+    Returns:
+        list: The ids of the cached nodes
+    """
+    messages = history.get("status", {}).get("messages", [])
+    for event, data in messages:
+        if event == "execution_cached":
+            return [str(node_id) for node_id in data.get("nodes", [])]
+    return []
+
+
+def cache_report(workflow, predicted, cached):
+    """
+    Returns which nodes of a job were predicted to be cached and which were actually cached
+
+    Args:
+        workflow (dict): The workflow of the job
+        predicted (list): The node ids from predict_cached
+        cached (list): The node ids from cached_nodes
+
+    Returns:
+        dict: The report, to be included in the job metrics
+    """
+    return {
+        "predicted_cached": predicted,
+        "cached": cached,
+        "executed": [node_id for node_id in workflow if node_id not in cached],
+        "mispredicted": sorted(set(predicted) ^ set(cached), key=node_sort_key),
+    }
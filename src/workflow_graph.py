@@ -0,0 +1,210 @@
+import json
+import threading
+from collections import Counter
+
+from scheduler import node_models
+from workflow_binder import (
+    canonicalize_node,
+    is_link,
+    node_signatures,
+    node_sort_key,
+    output_node_classes,
+    output_node_hosts,
+    strip_dead_nodes,
+    structure_id,
+)
+
+
+class BoundWorkflow:
+    """
+    A workflow ready to be queued, with everything the handler derives from it
+
+    The nodes are shared with the WorkflowGraph and must not be modified.
+    """
+
+    def __init__(self, workflow, serialized, models, signatures, structure, changed):
+        self.workflow = workflow
+        self.serialized = serialized
+        self.models = models
+        self.signatures = signatures
+        self.structure = structure
+        self.changed = changed
+
+
+def validate_node(node_id, node, workflow):
+    """
+    Raises a ValueError if a node is not a valid ComfyUI node in API format
+
+    Args:
+        node_id (str): The id of the node
+        node (dict): The node as submitted
+        workflow (dict): The workflow the node belongs to, links must point into it
+    """
+    if not isinstance(node, dict) or not isinstance(node.get("class_type"), str):
+        raise ValueError(f"node {node_id} has no 'class_type'")
+    inputs = node.get("inputs", {})
+    if not isinstance(inputs, dict):
+        raise ValueError(f"the inputs of node {node_id} are not an object")
+    for key, value in inputs.items():
+        if is_link(value) and str(value[0]) not in workflow:
+            raise ValueError(f"input '{key}' of node {node_id} links to missing node {value[0]}")
+
+
+class WorkflowGraph:
+    """
+    Keeps the last submitted workflow and only processes the nodes of a new workflow
+    that changed since then.
+
+    Consecutive jobs mostly differ in a single input, e.g. the image url of node 111
+    or a seed. Validation, canonicalization, model extraction, signatures and JSON
+    serialization are done for the changed nodes only, everything else is reused.
+    Nodes that are the same object as in the previous workflow, like the nodes of a
+    shared template, are not even compared.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # By node id: the node as submitted, its canonical form, its JSON entry, its
+        # models and the ids of the nodes it links to
+        self._raw = {}
+        self._nodes = {}
+        self._fragments = {}
+        self._models = {}
+        self._links = {}
+        # Ids of the nodes that link to a node, by node id
+        self._dependents = {}
+        self._signatures = {}
+        # Ids of all nodes and of the nodes an output depends on, in canonical order
+        self._order = []
+        self._live = []
+        self._live_ids = set()
+        # How many live nodes load each model
+        self._live_models = Counter()
+        # Sizes of output_node_hosts and output_node_classes as of the last relink
+        self._output_classes = (0, 0)
+        self._structure = None
+        self._bound = None
+
+    def bind(self, workflow):
+        """
+        Binds a workflow, reusing the results of the nodes that did not change
+
+        Args:
+            workflow (dict): A ComfyUI workflow in API format
+
+        Raises:
+            ValueError: If the workflow is not an object or a changed node is invalid,
+            the previous workflow is kept
+
+        Returns:
+            BoundWorkflow: The canonical workflow without dead nodes, and its JSON,
+            model set, node signatures and structure id
+        """
+        if not isinstance(workflow, dict):
+            raise ValueError("the workflow is not an object")
+        if any(not isinstance(node_id, str) for node_id in workflow):
+            workflow = {str(node_id): node for node_id, node in workflow.items()}
+        with self._lock:
+            return self._bind(workflow)
+
+    def _bind(self, workflow):
+        output_classes = (len(output_node_hosts), len(output_node_classes))
+        removed = [node_id for node_id in self._raw if node_id not in workflow]
+        changed = [
+            node_id
+            for node_id, node in workflow.items()
+            if self._raw.get(node_id) is not node and self._raw.get(node_id) != node
+        ]
+        if (
+            not changed
+            and not removed
+            and output_classes == self._output_classes
+            and self._bound is not None
+        ):
+            bound = self._bound
+            return BoundWorkflow(
+                bound.workflow, bound.serialized, bound.models, bound.signatures, bound.structure, []
+            )
+
+        # Validate everything before the state is updated, so that an invalid job
+        # doesn't affect the next one
+        for node_id in changed:
+            validate_node(node_id, workflow[node_id], workflow)
+        for node_id in removed:
+            for dependent in self._dependents.get(node_id, ()):
+                if dependent in workflow and dependent not in changed:
+                    raise ValueError(f"node {dependent} links to missing node {node_id}")
+
+        relink = bool(removed) or output_classes != self._output_classes
+        restructure = bool(removed)
+        for node_id in removed:
+            self._forget(node_id)
+        for node_id in changed:
+            node = canonicalize_node(workflow[node_id])
+            links = frozenset(value[0] for value in node["inputs"].values() if is_link(value))
+            previous = self._nodes.get(node_id)
+            if previous is None or previous["class_type"] != node["class_type"]:
+                relink = restructure = True
+            if links != self._links.get(node_id):
+                relink = True
+                self._unlink(node_id)
+                for link in links:
+                    self._dependents.setdefault(link, set()).add(node_id)
+            if node_id in self._live_ids:
+                self._live_models.subtract(self._models[node_id])
+            self._raw[node_id] = workflow[node_id]
+            self._nodes[node_id] = node
+            self._fragments[node_id] = f"{json.dumps(node_id)}: {json.dumps(node)}"
+            self._models[node_id] = node_models(node)
+            self._links[node_id] = links
+            if node_id in self._live_ids:
+                self._live_models.update(self._models[node_id])
+
+        if restructure:
+            self._order = sorted(self._nodes, key=node_sort_key)
+        if relink:
+            self._output_classes = output_classes
+            live = strip_dead_nodes({node_id: self._nodes[node_id] for node_id in self._order})
+            self._structure = structure_id(live)
+            self._live = list(live)
+            self._live_ids = set(live)
+            self._live_models = Counter()
+            for node_id in self._live:
+                self._live_models.update(self._models[node_id])
+        self._live_models = +self._live_models
+
+        # A signature covers all ancestors, so it changes with any changed ancestor
+        dirty = set()
+        pending = list(changed)
+        while pending:
+            node_id = pending.pop()
+            if node_id not in dirty:
+                dirty.add(node_id)
+                pending.extend(self._dependents.get(node_id, ()))
+        known = {
+            node_id: signature
+            for node_id, signature in self._signatures.items()
+            if node_id not in dirty and node_id in self._nodes
+        }
+        self._signatures = node_signatures(self._nodes, known)
+
+        self._bound = BoundWorkflow(
+            {node_id: self._nodes[node_id] for node_id in self._live},
+            "{" + ", ".join(self._fragments[node_id] for node_id in self._live) + "}",
+            frozenset(self._live_models),
+            {node_id: self._signatures[node_id] for node_id in self._live},
+            self._structure,
+            changed,
+        )
+        return self._bound
+
+    def _unlink(self, node_id):
+        for link in self._links.get(node_id, ()):
+            self._dependents.get(link, set()).discard(node_id)
+
+    def _forget(self, node_id):
+        self._unlink(node_id)
+        self._links.pop(node_id, None)
+        self._dependents.pop(node_id, None)
+        for store in (self._raw, self._nodes, self._fragments, self._models, self._signatures):
+            store.pop(node_id, None)
@@ -0,0 +1,193 @@
+"""
+A fake ComfyUI server that implements the parts of the API the worker uses.
+
+It can be started inside a test with FakeComfyUI().start() or as a separate process
+with `python tests/fake_comfyui.py --port 8188`. POST /debug/exit makes the process
+exit, POST /debug/hang makes it stop answering, to simulate crashes.
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeComfyUI:
+    def __init__(self, execution_time=0.05):
+        # Seconds it takes to "execute" a prompt, prompts are executed one after another
+        self.execution_time = execution_time
+        # Additional prompts in the queue, e.g. from other clients
+        self.external_queue = 0
+        self.prompts = {}
+        self.uploads = {}
+        self.hung = threading.Event()
+        self._last_prompt = {}
+        self._last_done_at = 0.0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def host(self):
+        return f"127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self, port=0):
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def queue_prompt(self, prompt):
+        with self._lock:
+            now = time.monotonic()
+            prompt_id = str(uuid.uuid4())
+            self._last_done_at = max(now, self._last_done_at) + self.execution_time
+            self.prompts[prompt_id] = {
+                "prompt": prompt,
+                "done_at": self._last_done_at,
+                "cached": self._cached_nodes(prompt),
+            }
+            self._last_prompt = prompt
+            return prompt_id
+
+    def _cached_nodes(self, prompt):
+        # Like ComfyUI, reuse a node if it and all its ancestors are unchanged
+        cached = {}
+
+        def is_cached(node_id):
+            if node_id not in cached:
+                node = prompt[node_id]
+                cached[node_id] = self._last_prompt.get(node_id) == node and all(
+                    is_cached(str(value[0]))
+                    for value in node["inputs"].values()
+                    if isinstance(value, list) and len(value) == 2
+                )
+            return cached[node_id]
+
+        return [node_id for node_id in prompt if is_cached(node_id)]
+
+    def queue(self):
+        now = time.monotonic()
+        pending = [
+            prompt_id
+            for prompt_id, prompt in self.prompts.items()
+            if prompt["done_at"] > now
+        ]
+        pending += [f"external-{i}" for i in range(self.external_queue)]
+        return {"queue_running": pending[:1], "queue_pending": pending[1:]}
+
+    def history(self, prompt_id):
+        prompt = self.prompts.get(prompt_id)
+        if prompt is None or prompt["done_at"] > time.monotonic():
+            return {}
+        return {
+            prompt_id: {
+                "prompt": [0, prompt_id, prompt["prompt"], {}, []],
+                "outputs": {
+                    "9": {
+                        "images": [
+                            {"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}
+                        ]
+                    }
+                },
+                "status": {
+                    "status_str": "success",
+                    "completed": True,
+                    "messages": [
+                        ["execution_start", {"prompt_id": prompt_id}],
+                        ["execution_cached", {"nodes": prompt["cached"], "prompt_id": prompt_id}],
+                        ["execution_success", {"prompt_id": prompt_id}],
+                    ],
+                },
+            }
+        }
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, data, status=200):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_body(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return self.rfile.read(length)
+
+            def do_GET(self):
+                if fake.hung.is_set():
+                    # Simulate a blocked event loop
+                    threading.Event().wait()
+                if self.path == "/":
+                    self._send_json({})
+                elif self.path == "/queue":
+                    self._send_json(fake.queue())
+                elif self.path == "/system_stats":
+                    self._send_json(
+                        {
+                            "system": {},
+                            "devices": [
+                                {"name": "cuda:0", "vram_total": 24 * 2**30, "vram_free": 16 * 2**30}
+                            ],
+                        }
+                    )
+                elif self.path == "/object_info":
+                    self._send_json(
+                        {
+                            name: {"output_node": output}
+                            for name, output in [
+                                ("LoadImage", False),
+                                ("SaveImage", True),
+                                ("SaveImageWebsocket", True),
+                                ("VHS_VideoCombine", True),
+                            ]
+                        }
+                    )
+                elif self.path.startswith("/history/"):
+                    self._send_json(fake.history(self.path[len("/history/"):]))
+                else:
+                    self._send_json({"error": "not found"}, 404)
+
+            def do_POST(self):
+                body = self._read_body()
+                if self.path == "/prompt":
+                    prompt = json.loads(body)["prompt"]
+                    prompt_id = fake.queue_prompt(prompt)
+                    self._send_json({"prompt_id": prompt_id, "number": 0, "node_errors": {}})
+                elif self.path == "/upload/image":
+                    name = str(uuid.uuid4())
+                    fake.uploads[name] = body
+                    self._send_json({"name": name, "subfolder": "", "type": "input"})
+                elif self.path == "/debug/exit":
+                    os._exit(1)
+                elif self.path == "/debug/hang":
+                    fake.hung.set()
+                    self._send_json({})
+                else:
+                    self._send_json({"error": "not found"}, 404)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--execution-time", type=float, default=0.05)
+    args, _ = parser.parse_known_args()
+
+    fake = FakeComfyUI(args.execution_time).start(args.port)
+    print(f"fake-comfyui - listening on {fake.host}", flush=True)
+    threading.Event().wait()
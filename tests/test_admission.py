@@ -0,0 +1,69 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+
+# Make sure that "src" is known and can be used to import admission.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from src.admission import AdmissionController
+from src.backends import Backend, BackendPool
+from src.scheduler import ModelAffinityScheduler
+
+
+class TestAdmissionController(unittest.TestCase):
+    def setUp(self):
+        self.backends = [Backend("127.0.0.1:8188", "/out"), Backend("127.0.0.1:8189", "/out")]
+        for backend in self.backends:
+            backend.healthy = True
+        self.pool = BackendPool(self.backends)
+        self.scheduler = ModelAffinityScheduler(self.pool)
+        self.admission = AdmissionController(self.pool, self.scheduler)
+
+    def test_admit_without_data(self):
+        self.assertEqual(self.admission.admit("sdxl", 10), (None, True))
+
+    def test_estimate_uses_queue_depth_and_template_time(self):
+        self.admission.record("sdxl", 2.0)
+        self.admission.record("flux", 10.0)
+        self.backends[0].queue_depth = 4
+        self.backends[1].queue_depth = 2
+
+        # Two prompts ahead at the mean execution time of 6 s, then 10 s for flux
+        self.assertEqual(self.admission.estimate("flux"), 22.0)
+        self.assertEqual(self.admission.admit("flux", 20), (22.0, False))
+        self.assertEqual(self.admission.admit("sdxl", 20), (14.0, True))
+
+    def test_record_averages_execution_times(self):
+        self.admission.record("sdxl", 2.0)
+        self.admission.record("sdxl", 12.0)
+
+        self.assertAlmostEqual(self.admission.execution_times["sdxl"], 5.0)
+
+    def test_concurrency_follows_capacity(self):
+        self.assertEqual(self.admission.concurrency(8, 60), 8)
+
+        self.admission.record("flux", 30.0)
+        self.assertEqual(self.admission.concurrency(8, 60), 4)
+
+        self.backends[0].queue_depth = 3
+        self.assertEqual(self.admission.concurrency(8, 60), 1)
+
+    def test_handler_rejects_job_that_would_miss_deadline(self):
+        self.admission.record("sdxl", 30.0)
+        self.backends[0].queue_depth = 5
+        self.backends[1].queue_depth = 5
+        workflow = {"9": {"inputs": {}, "class_type": "SaveImage"}}
+
+        with patch.object(rp_handler, "pool", self.pool), patch.object(
+            rp_handler, "scheduler", self.scheduler
+        ), patch.object(rp_handler, "admission", self.admission), patch.object(
+            rp_handler, "run_workflow"
+        ) as mock_run_workflow:
+            result = rp_handler.handler(
+                {"id": "123", "input": {"workflow": workflow, "deadline_s": 60}}
+            )
+
+        self.assertTrue(result["retryable"])
+        self.assertIn("deadline", result["error"])
+        mock_run_workflow.assert_not_called()
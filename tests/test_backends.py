@@ -0,0 +1,116 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+
+# Make sure that "src" is known and can be used to import backends.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import backends
+from src import rp_handler
+from src.scheduler import ModelAffinityScheduler
+from tests.fake_comfyui import FakeComfyUI
+
+SDXL = frozenset({"sd_xl_base_1.0.safetensors"})
+WORKFLOW = {
+    "4": {
+        "inputs": {"ckpt_name": "sd_xl_base_1.0.safetensors"},
+        "class_type": "CheckpointLoaderSimple",
+    }
+}
+
+
+class TestParseBackends(unittest.TestCase):
+    def test_hosts_with_and_without_output_path(self):
+        result = backends.parse_backends(
+            "127.0.0.1:8188, 127.0.0.1:8189=/comfyui/output-1", "/comfyui/output"
+        )
+
+        self.assertEqual([b.host for b in result], ["127.0.0.1:8188", "127.0.0.1:8189"])
+        self.assertEqual(
+            [b.output_path for b in result], ["/comfyui/output", "/comfyui/output-1"]
+        )
+
+
+class TestBackendPool(unittest.TestCase):
+    def setUp(self):
+        self.fakes = [FakeComfyUI().start() for _ in range(3)]
+        self.pool = backends.BackendPool(
+            backends.parse_backends(",".join(f.host for f in self.fakes), "/out"),
+            failure_threshold=2,
+        )
+
+    def tearDown(self):
+        for fake in self.fakes:
+            try:
+                fake.stop()
+            except Exception:
+                pass
+
+    def test_check_reads_queue_depth(self):
+        self.fakes[0].external_queue = 3
+
+        self.assertTrue(self.pool.check(self.pool.backends[0]))
+        self.assertTrue(self.pool.backends[0].healthy)
+        self.assertEqual(self.pool.backends[0].queue_depth, 3)
+
+    def test_select_least_loaded(self):
+        self.fakes[0].external_queue = 2
+        self.fakes[1].external_queue = 1
+        self.fakes[2].external_queue = 4
+        self.pool.check_all()
+
+        self.assertIs(self.pool.select(SDXL), self.pool.backends[1])
+
+    def test_select_prefers_resident_models(self):
+        self.pool.check_all()
+        self.pool.backends[2].resident = SDXL
+
+        self.assertIs(self.pool.select(SDXL), self.pool.backends[2])
+
+    def test_select_prefers_resident_models_over_stale_queue_depth(self):
+        self.pool.check_all()
+        # The job that just finished is still counted until the next health check
+        self.pool.backends[0].resident = SDXL
+        self.pool.backends[0].queue_depth = 1
+
+        self.assertIs(self.pool.select(SDXL), self.pool.backends[0])
+
+    def test_failed_backend_is_drained(self):
+        self.pool.check_all()
+        self.fakes[0].stop()
+
+        self.pool.check_all()
+        self.assertTrue(self.pool.backends[0].healthy)
+        self.pool.check_all()
+        self.assertFalse(self.pool.backends[0].healthy)
+        self.assertNotIn(self.pool.backends[0], self.pool.healthy_backends())
+        self.assertIsNot(self.pool.select(SDXL), self.pool.backends[0])
+
+    def test_handler_routes_jobs_to_healthy_backends(self):
+        self.pool.check_all()
+        sched = ModelAffinityScheduler(self.pool)
+        job = {"id": "123", "input": {"workflow": WORKFLOW}}
+
+        with patch.object(rp_handler, "pool", self.pool), patch.object(
+            rp_handler, "scheduler", sched
+        ), patch.object(
+            rp_handler, "process_output_images", return_value={"status": "success"}
+        ) as mock_process_output_images:
+            first = rp_handler.handler(job)
+            # The backend goes down without the health checks noticing it yet
+            self.fakes[0].stop()
+            self.pool.backends[1].resident = frozenset()
+            self.pool.backends[2].resident = frozenset()
+            second = rp_handler.handler(job)
+
+        self.assertEqual(first["metrics"]["backend"], self.fakes[0].host)
+        self.assertEqual(first["status"], "success")
+        self.assertNotEqual(second["metrics"]["backend"], self.fakes[0].host)
+        self.assertEqual(second["status"], "success")
+        self.assertFalse(self.pool.backends[0].healthy)
+        mock_process_output_images.assert_called_with(
+            {"9": {"images": [{"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}]}},
+            "123",
+            "/out",
+            rp_handler.NULL_TRACE,
+        )
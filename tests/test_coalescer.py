@@ -0,0 +1,122 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Make sure that "src" is known and can be used to import coalescer.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from src.backends import BackendPool, parse_backends
+from src.coalescer import Coalescer, job_key
+from src.scheduler import ModelAffinityScheduler
+from tests.fake_comfyui import FakeComfyUI
+
+
+class TestCoalescer(unittest.TestCase):
+    def test_job_key(self):
+        images = [{"name": "a.png", "image": "aGVsbG8="}]
+
+        self.assertEqual(job_key('{"9": {}}', images), job_key('{"9": {}}', list(images)))
+        self.assertNotEqual(job_key('{"9": {}}', images), job_key('{"9": {}}', None))
+        self.assertNotEqual(
+            job_key('{"9": {}}', images),
+            job_key('{"9": {}}', [{"name": "b.png", "image": "aGVsbG8="}]),
+        )
+
+    def test_concurrent_jobs_share_one_execution(self):
+        coalescer = Coalescer()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def execute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"status": "success"}
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            leader = executor.submit(coalescer.run, "key", execute)
+            started.wait(5)
+            followers = [executor.submit(coalescer.run, "key", execute) for _ in range(2)]
+            time.sleep(0.1)
+            release.set()
+            results = [leader.result()] + [follower.result() for follower in followers]
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results[0], ({"status": "success"}, 3, True))
+        self.assertEqual(results[1], ({"status": "success"}, 3, False))
+
+        # Later jobs run again
+        self.assertEqual(coalescer.run("key", lambda: {"status": "again"}), ({"status": "again"}, 1, True))
+
+    def test_followers_get_the_error(self):
+        coalescer = Coalescer()
+        started = threading.Event()
+
+        def execute():
+            started.set()
+            time.sleep(0.2)
+            raise RuntimeError("failed")
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(coalescer.run, "key", execute)
+            started.wait(5)
+            follower = executor.submit(coalescer.run, "key", execute)
+            with self.assertRaises(RuntimeError):
+                leader.result()
+            with self.assertRaises(RuntimeError):
+                follower.result()
+
+    def test_coalesced_errors_get_their_own_trace(self):
+        workflow = {"9": {"inputs": {"filename_prefix": "errors"}, "class_type": "SaveImage"}}
+
+        def execute_job(job, trace, bound, images):
+            time.sleep(0.5)
+            return {"error": "Error waiting for image generation", "retryable": True}
+
+        with patch.object(rp_handler, "execute_job", side_effect=execute_job) as mock_execute_job:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                results = list(
+                    executor.map(
+                        rp_handler.handler,
+                        [
+                            {"id": f"job-{i}", "input": {"workflow": workflow, "trace": True}}
+                            for i in range(2)
+                        ],
+                    )
+                )
+
+        mock_execute_job.assert_called_once()
+        self.assertIsNot(results[0], results[1])
+        for i, result in enumerate(results):
+            self.assertEqual(result["error"], "Error waiting for image generation")
+            self.assertEqual(result["trace"]["traceEvents"][0]["args"], {"name": f"job job-{i}"})
+
+    def test_handler_coalesces_identical_jobs(self):
+        fake = FakeComfyUI(execution_time=0.5).start()
+        self.addCleanup(fake.stop)
+        pool = BackendPool(parse_backends(fake.host, "/out"))
+        pool.check_all()
+        workflow = {"9": {"inputs": {"filename_prefix": "coalesce"}, "class_type": "SaveImage"}}
+
+        with patch.object(rp_handler, "pool", pool), patch.object(
+            rp_handler, "scheduler", ModelAffinityScheduler(pool, slots=3)
+        ), patch.object(
+            rp_handler, "process_output_images", return_value={"status": "success"}
+        ) as mock_process_output_images:
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                results = list(
+                    executor.map(
+                        rp_handler.handler,
+                        [{"id": str(i), "input": {"workflow": workflow}} for i in range(3)],
+                    )
+                )
+
+        self.assertEqual(len(fake.prompts), 1)
+        mock_process_output_images.assert_called_once()
+        self.assertEqual([result["metrics"]["coalesced_jobs"] for result in results], [3, 3, 3])
+        self.assertEqual(sum(not result["metrics"]["coalesced"] for result in results), 1)
@@ -0,0 +1,131 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+import os
+import base64
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+# Make sure that "src" is known and can be used to import input_stage.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import input_stage
+from src import rp_handler
+from src.backends import BackendPool, parse_backends
+from src.scheduler import ModelAffinityScheduler
+from tests.fake_comfyui import FakeComfyUI
+
+
+def encode_image(size, image_format):
+    buffer = BytesIO()
+    Image.new("RGB", size, (200, 100, 50)).save(buffer, format=image_format)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+class TestInputStage(unittest.TestCase):
+    def test_parse_resolutions(self):
+        self.assertEqual(
+            input_stage.parse_resolutions("workflow=1024x1024, inline-1a2b3c4d=768X512"),
+            {"workflow": 1048576, "inline-1a2b3c4d": 393216},
+        )
+        self.assertEqual(input_stage.parse_resolutions(""), {})
+
+    def test_detect_mime_type(self):
+        for image_format, mime_type in [
+            ("PNG", "image/png"),
+            ("JPEG", "image/jpeg"),
+            ("WEBP", "image/webp"),
+        ]:
+            blob = base64.b64decode(encode_image((8, 8), image_format))
+            self.assertEqual(input_stage.detect_mime_type(blob), mime_type)
+        self.assertEqual(input_stage.detect_mime_type(b"data"), "application/octet-stream")
+
+    def test_downscale_to_template_resolution(self):
+        image = {"name": "photo.jpg", "image": encode_image((4000, 3000), "JPEG")}
+
+        prepared = input_stage.prepare_image(image, max_pixels=1024 * 1024)
+
+        self.assertTrue(prepared.resized)
+        self.assertEqual(prepared.mime_type, "image/jpeg")
+        with Image.open(BytesIO(prepared.blob)) as img:
+            self.assertEqual(img.format, "JPEG")
+            self.assertLessEqual(img.width * img.height, 1024 * 1024)
+            self.assertEqual(round(img.width / img.height, 2), 1.33)
+
+    def test_small_image_is_kept(self):
+        image = {"name": "small.png", "image": encode_image((64, 64), "PNG")}
+
+        prepared = input_stage.prepare_image(image, max_pixels=1024 * 1024)
+
+        self.assertFalse(prepared.resized)
+        self.assertEqual(prepared.blob, base64.b64decode(image["image"]))
+
+    @patch("input_stage.requests.post")
+    def test_upload_sends_mime_type_and_skips_identical_content(self, mock_post):
+        mock_post.return_value = MagicMock(status_code=200)
+        images = [
+            {"name": "a.jpg", "image": encode_image((8, 8), "JPEG")},
+            {"name": "b.png", "image": encode_image((8, 8), "PNG")},
+        ]
+        uploaded = {}
+
+        prepared = input_stage.prepare_images(images)
+        first = input_stage.upload_prepared_images(prepared, "127.0.0.1:8188", uploaded)
+        second = input_stage.upload_prepared_images(prepared, "127.0.0.1:8188", uploaded)
+
+        self.assertEqual(first["status"], "success")
+        self.assertEqual(second["status"], "success")
+        self.assertEqual(mock_post.call_count, 2)
+        mime_types = sorted(
+            call.kwargs["files"]["image"][2] for call in mock_post.call_args_list
+        )
+        self.assertEqual(mime_types, ["image/jpeg", "image/png"])
+        self.assertEqual(
+            second["details"],
+            ["Skipped a.jpg, it is already uploaded", "Skipped b.png, it is already uploaded"],
+        )
+
+    @patch("input_stage.requests.post")
+    def test_upload_connection_error(self, mock_post):
+        mock_post.side_effect = input_stage.requests.ConnectionError("refused")
+        prepared = input_stage.prepare_images([{"name": "a.png", "image": encode_image((8, 8), "PNG")}])
+
+        result = input_stage.upload_prepared_images(prepared, "127.0.0.1:8188")
+
+        self.assertEqual(result["status"], "error")
+        self.assertIn("refused", result["details"][0])
+
+    def test_images_are_prepared_while_waiting_for_backend(self):
+        fake = FakeComfyUI().start()
+        self.addCleanup(fake.stop)
+        pool = BackendPool(parse_backends(fake.host, "/out"))
+        pool.check_all()
+        sched = ModelAffinityScheduler(pool)
+        waiting = threading.Event()
+        acquire = sched.acquire
+
+        def wait_for_backend(*args):
+            waiting.set()
+            return acquire(*args)
+
+        def prepare_images(images, max_pixels, workers):
+            # Only finishes if the job waits for a backend meanwhile
+            self.assertTrue(waiting.wait(5))
+            return input_stage.prepare_images(images, max_pixels, workers)
+
+        workflow = {"9": {"inputs": {}, "class_type": "SaveImage"}}
+        images = [{"name": "a.png", "image": encode_image((8, 8), "PNG")}]
+        with patch.object(rp_handler, "pool", pool), patch.object(
+            rp_handler, "scheduler", sched
+        ), patch.object(sched, "acquire", side_effect=wait_for_backend), patch.object(
+            rp_handler, "prepare_images", side_effect=prepare_images
+        ), patch.object(
+            rp_handler, "process_output_images", return_value={"status": "success"}
+        ):
+            result = rp_handler.handler(
+                {"id": "123", "input": {"workflow": workflow, "images": images}}
+            )
+
+        self.assertEqual(result["metrics"]["input_images"]["count"], 1)
+        self.assertEqual(len(fake.uploads), 1)
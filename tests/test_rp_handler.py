@@ -8,6 +8,9 @@ import base64
 # Make sure that "src" is known and can be used to import rp_handler.py
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
 from src import rp_handler
+from src.admission import AdmissionController
+from src.backends import Backend, BackendPool
+from src.scheduler import ModelAffinityScheduler
 
 # Local folder for test resources
 RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES = "./test_resources/images"
@@ -64,6 +67,19 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIsNotNone(error)
         self.assertEqual(error, "Please provide input")
 
+    def test_handler_rejects_images_that_are_not_strings(self):
+        workflow = {"9": {"inputs": {}, "class_type": "SaveImage"}}
+
+        for images in [[{"name": 1, "image": "aGVsbG8="}], [{"name": "a.png", "image": None}], ["a.png"]]:
+            result = rp_handler.handler(
+                {"id": "123", "input": {"workflow": workflow, "images": images}}
+            )
+
+            self.assertEqual(
+                result,
+                {"error": "'images' must be a list of objects with 'name' and 'image' keys"},
+            )
+
     @patch("rp_handler.requests.get")
     def test_check_server_server_up(self, mock_requests):
         mock_response = MagicMock()
@@ -112,7 +128,9 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         # Assertions
         self.assertEqual(result, {"key": "value"})
-        mock_urlopen.assert_called_with("http://127.0.0.1:8188/history/123")
+        mock_urlopen.assert_called_with(
+            "http://127.0.0.1:8188/history/123", timeout=rp_handler.COMFY_HANG_TIMEOUT_S
+        )
 
     @patch("builtins.open", new_callable=mock_open, read_data=b"test")
     def test_base64_encode(self, mock_file):
@@ -232,3 +250,32 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "error")
+
+    @patch.object(rp_handler, "process_output_images")
+    @patch.object(rp_handler, "run_workflow")
+    def test_handler_reports_scheduling_metrics(self, mock_run_workflow, mock_process_output_images):
+        # A pool of its own, so that the backend state doesn't leak into other tests
+        backend = Backend("127.0.0.1:8188", "/out")
+        backend.healthy = True
+        pool = BackendPool([backend])
+        scheduler = ModelAffinityScheduler(pool)
+        mock_run_workflow.return_value = ({"outputs": {}}, None)
+        mock_process_output_images.return_value = {"status": "success", "message": "x"}
+        workflow = {
+            "4": {
+                "inputs": {"ckpt_name": "sd_xl_base_1.0.safetensors"},
+                "class_type": "CheckpointLoaderSimple",
+            }
+        }
+
+        with patch.object(rp_handler, "pool", pool), patch.object(
+            rp_handler, "scheduler", scheduler
+        ), patch.object(
+            rp_handler, "admission", AdmissionController(pool, scheduler)
+        ):
+            result = rp_handler.handler({"id": "123", "input": {"workflow": workflow}})
+
+        self.assertEqual(result["status"], "success")
+        self.assertIn("model_swap", result["metrics"])
+        self.assertEqual(result["metrics"]["backend"], backend.host)
+        self.assertEqual(backend.resident, {"sd_xl_base_1.0.safetensors"})
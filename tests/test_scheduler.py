@@ -0,0 +1,192 @@
+import unittest
+import sys
+import os
+import json
+import threading
+import time
+
+# Make sure that "src" is known and can be used to import scheduler.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import scheduler
+from src.backends import Backend, BackendPool
+from tests.fake_comfyui import FakeComfyUI
+
+# Local folder for test resources
+RUNPOD_WORKER_COMFY_TEST_RESOURCES_WORKFLOWS = "./test_resources/workflows"
+
+
+def load_workflow(name):
+    path = os.path.join(RUNPOD_WORKER_COMFY_TEST_RESOURCES_WORKFLOWS, name)
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)["input"]["workflow"]
+
+
+FLUX_DEV = frozenset({"flux1-dev.safetensors", "ae.safetensors"})
+FLUX_SCHNELL = frozenset({"flux1-schnell.safetensors", "ae.safetensors"})
+SD3 = frozenset({"sd3_medium_incl_clips_t5xxlfp8.safetensors"})
+
+
+class TestExtractModels(unittest.TestCase):
+    def test_flux1_dev(self):
+        models = scheduler.extract_models(load_workflow("workflow_flux1_dev.json"))
+        self.assertEqual(
+            models,
+            {
+                "flux1-dev.safetensors",
+                "ae.safetensors",
+                "t5xxl_fp8_e4m3fn.safetensors",
+                "clip_l.safetensors",
+            },
+        )
+
+    def test_sdxl_turbo(self):
+        models = scheduler.extract_models(load_workflow("workflow_sdxl_turbo.json"))
+        self.assertEqual(models, {"sd_xl_turbo_1.0_fp16.safetensors"})
+
+    def test_ignores_non_model_strings(self):
+        workflow = {
+            "1": {"inputs": {"sampler_name": "euler", "text": "a.safetensors"}},
+            "2": {"inputs": {"lora_name": "detail.safetensors", "model": ["1", 0]}},
+        }
+        self.assertEqual(scheduler.extract_models(workflow), {"detail.safetensors"})
+
+
+class TestModelAffinityScheduler(unittest.TestCase):
+    def setUp(self):
+        self.backend = Backend("127.0.0.1:8188", "/comfyui/output")
+        self.backend.healthy = True
+        self.pool = BackendPool([self.backend])
+
+    def enqueue(self, sched, models, enqueued_at):
+        ticket = scheduler.Ticket(models)
+        ticket.enqueued_at = enqueued_at
+        sched._waiting.append(ticket)
+        return ticket
+
+    def test_prefers_resident_models(self):
+        sched = scheduler.ModelAffinityScheduler(self.pool, starvation_window=30)
+        self.backend.resident = FLUX_DEV
+        self.enqueue(sched, SD3, 100)
+        matching = self.enqueue(sched, FLUX_DEV, 101)
+
+        self.assertIs(sched.next_ticket(now=102), matching)
+
+    def test_starved_job_goes_first(self):
+        sched = scheduler.ModelAffinityScheduler(self.pool, starvation_window=30)
+        self.backend.resident = FLUX_DEV
+        starved = self.enqueue(sched, SD3, 100)
+        self.enqueue(sched, FLUX_DEV, 101)
+
+        self.assertIs(sched.next_ticket(now=130), starved)
+
+    def test_fifo_without_matching_job(self):
+        sched = scheduler.ModelAffinityScheduler(self.pool, starvation_window=30)
+        self.backend.resident = FLUX_DEV
+        oldest = self.enqueue(sched, SD3, 100)
+        self.enqueue(sched, FLUX_SCHNELL, 101)
+
+        self.assertIs(sched.next_ticket(now=102), oldest)
+
+    def test_concurrent_jobs_are_grouped_by_model(self):
+        sched = scheduler.ModelAffinityScheduler(self.pool, starvation_window=30)
+        first = sched.acquire(FLUX_DEV)
+        order = []
+
+        def run(models, name):
+            ticket = sched.acquire(models)
+            order.append(name)
+            sched.release(ticket, 1.0)
+
+        threads = []
+        for models, name in [(SD3, "sd3"), (FLUX_DEV, "flux")]:
+            thread = threading.Thread(target=run, args=(models, name))
+            thread.start()
+            threads.append(thread)
+            # Make sure the jobs arrive in order
+            while len(sched._waiting) < len(threads):
+                time.sleep(0.001)
+
+        sched.release(first, 1.0)
+        for thread in threads:
+            thread.join(timeout=5)
+
+        self.assertEqual(order, ["flux", "sd3"])
+        self.assertEqual(sched.swaps, 1)
+        self.assertEqual(sched.swaps_avoided, 1)
+
+    def test_metrics_report_time_saved(self):
+        sched = scheduler.ModelAffinityScheduler(self.pool, starvation_window=30)
+        sched.release(sched.acquire(FLUX_DEV), 2.0)
+        swapped = sched.acquire(SD3)
+        sched.release(swapped, 12.0)
+        sched.swaps_avoided = 2
+
+        metrics = sched.metrics(swapped)
+
+        self.assertTrue(metrics["model_swap"])
+        self.assertEqual(metrics["model_swaps_total"], 1)
+        self.assertEqual(metrics["time_saved_s_total"], 20.0)
+
+    def test_prefers_backend_with_resident_models(self):
+        other = Backend("127.0.0.1:8189", "/comfyui/output")
+        other.healthy = True
+        other.resident = SD3
+        self.backend.resident = FLUX_DEV
+        self.pool.backends.append(other)
+        sched = scheduler.ModelAffinityScheduler(self.pool, starvation_window=30)
+
+        sd3 = sched.acquire(SD3)
+        flux = sched.acquire(FLUX_DEV)
+
+        self.assertIs(sd3.backend, other)
+        self.assertIs(flux.backend, self.backend)
+        self.assertEqual(sched.swaps, 0)
+
+    def test_acquire_times_out_without_healthy_backend(self):
+        self.backend.healthy = False
+        sched = scheduler.ModelAffinityScheduler(self.pool, starvation_window=30)
+
+        self.assertIsNone(sched.acquire(SD3, timeout=0.1))
+        self.assertEqual(sched._waiting, [])
+
+    def test_acquire_waits_for_busy_backend_beyond_timeout(self):
+        sched = scheduler.ModelAffinityScheduler(self.pool, starvation_window=30)
+        first = sched.acquire(SD3)
+        threading.Timer(0.8, sched.release, args=(first, 1.0)).start()
+
+        second = sched.acquire(SD3, timeout=0.1)
+
+        self.assertIsNotNone(second)
+        self.assertIs(second.backend, self.backend)
+
+    def test_backend_becoming_healthy_dispatches_right_away(self):
+        fake = FakeComfyUI().start()
+        self.addCleanup(fake.stop)
+        backend = Backend(fake.host, "/comfyui/output")
+        pool = BackendPool([backend])
+        sched = scheduler.ModelAffinityScheduler(pool, starvation_window=30)
+        threading.Timer(0.1, pool.check, args=(backend,)).start()
+
+        ticket = sched.acquire(SD3, timeout=5)
+
+        self.assertIs(ticket.backend, backend)
+        self.assertLess(ticket.queue_wait, 0.4)
+
+    def test_dispatch_keeps_ticket_when_backend_is_drained(self):
+        sched = scheduler.ModelAffinityScheduler(self.pool, starvation_window=30)
+        first = self.enqueue(sched, SD3, 100)
+        second = self.enqueue(sched, FLUX_DEV, 101)
+        # The backend is drained between next_ticket and select
+        original_select = self.pool.select
+        self.pool.select = lambda models, slots=1: None
+
+        with sched._cond:
+            sched._dispatch()
+
+        self.assertEqual(sched._waiting, [first, second])
+        self.assertIsNone(first.granted_at)
+
+        self.pool.select = original_select
+        with sched._cond:
+            sched._dispatch()
+        self.assertIs(first.backend, self.backend)
@@ -0,0 +1,55 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+import tempfile
+
+# Make sure that "src" is known and can be used to import startup_profiler.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from src.startup_profiler import StartupProfiler
+
+
+class TestStartupProfiler(unittest.TestCase):
+    def test_report_includes_shell_and_python_steps(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".tsv", delete=False) as file:
+            file.write("tcmalloc lookup\t100.0\t100.5\n")
+            file.write("huggingface-cli login\t100.5\t103.0\n")
+        self.addCleanup(os.remove, file.name)
+        profiler = StartupProfiler(100.0, file.name)
+        profiler.add("import rp_handler", 101.0, 101.25)
+
+        with patch("startup_profiler.time.time", return_value=110.0):
+            report = profiler.first_job()
+
+        self.assertEqual(report["to_first_job_s"], 10.0)
+        self.assertEqual(
+            report["steps"],
+            [
+                {"name": "start.sh: tcmalloc lookup", "start_s": 0.0, "duration_s": 0.5},
+                {"name": "start.sh: huggingface-cli login", "start_s": 0.5, "duration_s": 2.5},
+                {"name": "import rp_handler", "start_s": 1.0, "duration_s": 0.25},
+            ],
+        )
+
+    def test_only_first_job_gets_report(self):
+        profiler = StartupProfiler()
+        profiler.mark("import rp_handler")
+
+        self.assertIsNotNone(profiler.first_job())
+        self.assertIsNone(profiler.first_job())
+
+    @patch.object(rp_handler, "process_output_images")
+    @patch.object(rp_handler, "run_workflow")
+    def test_handler_reports_cold_start_on_first_job(self, mock_run_workflow, mock_process_output_images):
+        rp_handler.pool.backends[0].healthy = True
+        mock_run_workflow.return_value = ({"outputs": {}}, None)
+        mock_process_output_images.return_value = {"status": "success", "message": "x"}
+        job = {"id": "123", "input": {"workflow": {"9": {"inputs": {}, "class_type": "SaveImage"}}}}
+
+        with patch.object(rp_handler, "profiler", StartupProfiler()):
+            first = rp_handler.handler(job)
+            second = rp_handler.handler(job)
+
+        self.assertIn("to_first_job_s", first["metrics"]["cold_start"])
+        self.assertNotIn("cold_start", second["metrics"])
@@ -0,0 +1,143 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+import os
+import socket
+import threading
+import time
+import urllib.request
+
+# Make sure that "src" is known and can be used to import supervisor.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from src.backends import Backend, BackendPool
+from src.scheduler import ModelAffinityScheduler
+from src.supervisor import ComfySupervisor
+
+FAKE_COMFYUI = os.path.join(os.path.dirname(__file__), "fake_comfyui.py")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def post(backend, path):
+    try:
+        urllib.request.urlopen(
+            urllib.request.Request(f"{backend.url}{path}", data=b""), timeout=1
+        )
+    except Exception:
+        # The fake ComfyUI exits or hangs before answering
+        pass
+
+
+class TestComfySupervisor(unittest.TestCase):
+    def start_supervisor(self, execution_time=0.05, warmup=None):
+        self.backend = Backend(f"127.0.0.1:{free_port()}", "/out")
+        self.pool = BackendPool([self.backend], failure_threshold=1)
+        self.warmup = warmup or MagicMock()
+        command = [
+            sys.executable,
+            FAKE_COMFYUI,
+            "--port",
+            self.backend.host.rpartition(":")[2],
+            "--execution-time",
+            str(execution_time),
+        ]
+        self.supervisor = ComfySupervisor(
+            command,
+            self.backend,
+            self.pool,
+            check_interval=0.1,
+            hang_timeout=0.5,
+            startup_timeout=10,
+            warmup=self.warmup,
+        )
+        self.supervisor.start()
+        self.addCleanup(self.supervisor.stop)
+        self.assertTrue(wait_for(lambda: self.supervisor.ready))
+        self.pool.check(self.backend)
+
+    def test_warmup_after_start(self):
+        self.start_supervisor()
+
+        self.assertTrue(wait_for(lambda: self.warmup.called))
+        self.warmup.assert_called_once_with(self.backend)
+        self.assertEqual(self.backend.restarts, 0)
+
+    def test_restart_after_exit(self):
+        self.start_supervisor()
+        process = self.supervisor.process
+
+        post(self.backend, "/debug/exit")
+
+        self.assertTrue(wait_for(lambda: self.backend.restarts == 1))
+        self.assertFalse(self.backend.healthy)
+        self.assertTrue(wait_for(lambda: self.supervisor.ready))
+        self.assertIsNot(self.supervisor.process, process)
+        self.assertTrue(wait_for(lambda: self.warmup.call_count == 2))
+
+    def test_restart_when_hung(self):
+        self.start_supervisor()
+
+        post(self.backend, "/debug/hang")
+
+        self.assertTrue(wait_for(lambda: self.backend.restarts == 1))
+        self.assertTrue(wait_for(lambda: self.supervisor.ready))
+
+    def test_restart_when_hung_during_warmup(self):
+        finished = threading.Event()
+        self.addCleanup(finished.set)
+
+        def warmup(backend):
+            # The warmup prompt never finishes because ComfyUI hangs
+            post(backend, "/debug/hang")
+            finished.wait()
+
+        self.start_supervisor(warmup=MagicMock(side_effect=warmup))
+
+        self.assertTrue(wait_for(lambda: self.backend.restarts >= 1))
+
+    def test_request_to_hung_comfyui_times_out(self):
+        self.start_supervisor()
+        post(self.backend, "/debug/hang")
+
+        started_at = time.monotonic()
+        with patch.object(rp_handler, "COMFY_HANG_TIMEOUT_S", 0.5):
+            with self.assertRaises(OSError):
+                rp_handler.get_history("123", self.backend.host)
+
+        self.assertLess(time.monotonic() - started_at, 5)
+
+    def test_in_flight_job_fails_fast(self):
+        self.start_supervisor(execution_time=30)
+        sched = ModelAffinityScheduler(self.pool)
+        job = {"id": "123", "input": {"workflow": {"9": {"inputs": {}, "class_type": "SaveImage"}}}}
+
+        def get_history(prompt_id, host):
+            # ComfyUI crashes while the job is executed
+            post(self.backend, "/debug/exit")
+            return {}
+
+        with patch.object(rp_handler, "pool", self.pool), patch.object(
+            rp_handler, "scheduler", sched
+        ), patch.object(
+            rp_handler, "get_history", side_effect=get_history
+        ):
+            started_at = time.monotonic()
+            result = rp_handler.handler(job)
+
+        self.assertLess(time.monotonic() - started_at, 5)
+        self.assertEqual(result["error"], "ComfyUI was restarted while executing the workflow")
+        self.assertTrue(result["retryable"])
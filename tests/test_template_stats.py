@@ -0,0 +1,100 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+import io
+import json
+import tempfile
+
+# Make sure that "src" is known and can be used to import template_stats.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from src import template_stats
+from src.backends import BackendPool, parse_backends
+from src.scheduler import ModelAffinityScheduler
+from tests.fake_comfyui import FakeComfyUI
+
+
+class TestTemplateStats(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "stats", "stats.sqlite3")
+        self.stats = template_stats.TemplateStats(self.path)
+
+    def record_jobs(self, template, execution_times):
+        for execution_s in execution_times:
+            self.stats.record(template, execution_s, 1000, 8 * 2**30, 0.5)
+
+    def test_quantiles_survive_restart(self):
+        self.record_jobs("sdxl", range(1, 102))
+
+        summary = template_stats.TemplateStats(self.path).load()["sdxl"]
+
+        self.assertEqual(summary["samples"], 101)
+        self.assertEqual(summary["execution_s"], {"p50": 51, "p90": 91, "p99": 100})
+        self.assertEqual(summary["output_bytes"]["p50"], 1000)
+        self.assertEqual(summary["cache_hit_rate"]["p99"], 0.5)
+
+    def test_load_keeps_latest_samples(self):
+        self.record_jobs("sdxl", range(5))
+
+        with patch.object(template_stats, "MAX_SAMPLES", 3):
+            self.assertEqual(self.stats.load(prune=False)["sdxl"]["samples"], 5)
+            self.assertEqual(self.stats.load()["sdxl"]["execution_s"]["p50"], 3)
+            self.assertEqual(self.stats.load()["sdxl"]["samples"], 3)
+
+    def test_deadline_and_polling_interval(self):
+        self.record_jobs("flux", [40.0] * 20)
+        self.record_jobs("sdxl", [2.0] * 20)
+        self.record_jobs("new", [40.0] * 2)
+        self.stats.load()
+
+        self.assertEqual(self.stats.deadline("flux"), 120.0)
+        self.assertEqual(self.stats.polling_interval_ms("flux", 250), 800)
+        self.assertEqual(self.stats.polling_interval_ms("sdxl", 250), 250)
+        self.assertIsNone(self.stats.deadline("new"))
+        self.assertEqual(self.stats.polling_interval_ms("new", 250), 250)
+
+    def test_cli_reports_quantiles(self):
+        self.record_jobs("sdxl", [2.0, 4.0])
+        output = io.StringIO()
+
+        with patch.object(sys, "argv", ["template_stats.py", "--path", self.path, "--json"]), patch(
+            "sys.stdout", output
+        ):
+            template_stats.main()
+
+        self.assertEqual(json.loads(output.getvalue())["sdxl"]["execution_s"]["p50"], 3.0)
+
+    def test_handler_records_job(self):
+        fake = FakeComfyUI().start()
+        self.addCleanup(fake.stop)
+        pool = BackendPool(parse_backends(fake.host, "/out"))
+        pool.check_all()
+        workflow = {"9": {"inputs": {}, "class_type": "SaveImage"}}
+
+        with patch.object(rp_handler, "pool", pool), patch.object(
+            rp_handler, "scheduler", ModelAffinityScheduler(pool)
+        ), patch.object(rp_handler, "stats", self.stats), patch.object(
+            rp_handler, "process_output_images", return_value={"status": "success"}
+        ):
+            result = rp_handler.handler({"id": "123", "input": {"workflow": workflow}})
+
+        summary = self.stats.load()[result["metrics"]["template"]]
+        self.assertEqual(summary["samples"], 1)
+        self.assertEqual(summary["peak_vram_bytes"]["p50"], 8 * 2**30)
+        self.assertEqual(summary["output_bytes"]["p50"], 0)
+
+    def test_load_stats_keeps_estimates_of_finished_jobs(self):
+        self.record_jobs("sdxl", [2.0, 4.0])
+        self.record_jobs("flux", [10.0])
+        admission = rp_handler.AdmissionController(None, None)
+        admission.record("flux", 30.0)
+
+        with patch.object(rp_handler, "stats", self.stats), patch.object(
+            rp_handler, "admission", admission
+        ):
+            rp_handler.load_stats()
+
+        self.assertEqual(admission.execution_times, {"sdxl": 3.0, "flux": 30.0})
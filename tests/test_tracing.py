@@ -0,0 +1,126 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+import os
+import json
+import tempfile
+
+# Make sure that "src" is known and can be used to import tracing.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from src import tracing
+from src.backends import BackendPool, parse_backends
+from src.scheduler import ModelAffinityScheduler
+from tests.fake_comfyui import FakeComfyUI
+
+WORKFLOW = {
+    "10": {"inputs": {"vae_name": "ae.safetensors"}, "class_type": "VAELoader"},
+    "9": {"inputs": {"filename_prefix": "ComfyUI", "vae": ["10", 0]}, "class_type": "SaveImage"},
+}
+
+
+class FakeWebSocket:
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.closed = False
+
+    def settimeout(self, timeout):
+        pass
+
+    def recv(self):
+        if not self.messages:
+            raise ConnectionError("closed")
+        return json.dumps(self.messages.pop(0))
+
+    def close(self):
+        self.closed = True
+
+
+class TestTrace(unittest.TestCase):
+    def test_span_is_exported_as_complete_event(self):
+        trace = tracing.Trace("123")
+
+        with trace.span("POST /prompt", "http", backend="127.0.0.1:8188"):
+            pass
+
+        events = trace.to_chrome()["traceEvents"]
+        span = [event for event in events if event["ph"] == "X"][0]
+        self.assertEqual(span["name"], "POST /prompt")
+        self.assertEqual(span["cat"], "http")
+        self.assertEqual(span["args"], {"backend": "127.0.0.1:8188"})
+        self.assertGreaterEqual(span["ts"], 0)
+        self.assertGreaterEqual(span["dur"], 0)
+        self.assertIn("job 123", [event["args"]["name"] for event in events if event["ph"] == "M"])
+
+    def test_write(self):
+        trace = tracing.Trace("123")
+        with trace.span("bind_workflow"):
+            pass
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = trace.write(directory)
+            with open(path, encoding="utf-8") as file:
+                written = json.load(file)
+
+        self.assertEqual(os.path.basename(path), "123.trace.json")
+        self.assertEqual(written, trace.to_chrome())
+
+    def test_should_trace(self):
+        self.assertTrue(tracing.should_trace({"trace": True}, 0))
+        self.assertTrue(tracing.should_trace({}, 1))
+        self.assertFalse(tracing.should_trace({}, 0))
+
+    def test_node_event_listener(self):
+        websocket = FakeWebSocket(
+            [
+                {"type": "status", "data": {"status": {}}},
+                {"type": "execution_cached", "data": {"nodes": ["10"]}},
+                {"type": "executing", "data": {"node": "9"}},
+                {"type": "executing", "data": {"node": None}},
+            ]
+        )
+        trace = tracing.Trace("123")
+
+        with patch.object(tracing, "websocket", MagicMock()) as mock_websocket:
+            mock_websocket.create_connection.return_value = websocket
+            listener = tracing.NodeEventListener.start("127.0.0.1:8188", "abc", trace, WORKFLOW)
+            listener.close()
+
+        mock_websocket.create_connection.assert_called_with(
+            "ws://127.0.0.1:8188/ws?clientId=abc", timeout=tracing.WEBSOCKET_TIMEOUT_S
+        )
+        self.assertTrue(websocket.closed)
+        self.assertEqual(
+            [(event["name"], event["tid"]) for event in trace.events],
+            [("VAELoader #10 (cached)", tracing.COMFY_TID), ("SaveImage #9", tracing.COMFY_TID)],
+        )
+
+    def test_no_listener_without_trace(self):
+        with patch.object(tracing, "websocket", MagicMock()) as mock_websocket:
+            listener = tracing.NodeEventListener.start(
+                "127.0.0.1:8188", "abc", tracing.NULL_TRACE, WORKFLOW
+            )
+
+        self.assertIsNone(listener)
+        mock_websocket.create_connection.assert_not_called()
+
+    def test_handler_returns_trace(self):
+        fake = FakeComfyUI().start()
+        self.addCleanup(fake.stop)
+        pool = BackendPool(parse_backends(fake.host, "/out"))
+        pool.check_all()
+
+        with tempfile.TemporaryDirectory() as directory, patch.object(
+            rp_handler, "pool", pool
+        ), patch.object(rp_handler, "scheduler", ModelAffinityScheduler(pool)), patch.object(
+            rp_handler, "COMFY_TRACE_DIR", directory
+        ), patch.object(
+            rp_handler, "process_output_images", return_value={"status": "success"}
+        ):
+            result = rp_handler.handler({"id": "123", "input": {"workflow": WORKFLOW, "trace": True}})
+            self.assertTrue(os.path.isfile(result["metrics"]["trace_path"]))
+
+        names = {event["name"] for event in result["trace"]["traceEvents"]}
+        self.assertTrue(
+            {"handler", "bind_workflow", "wait_for_backend", "POST /prompt", "GET /history"} <= names
+        )
@@ -0,0 +1,208 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+import json
+import tempfile
+
+# Make sure that "src" is known and can be used to import workflow_binder.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from src import workflow_binder
+from src.backends import BackendPool, parse_backends
+from src.scheduler import ModelAffinityScheduler
+from tests.fake_comfyui import FakeComfyUI
+
+# A template like the one at COMFY_WORKFLOW_PATH, with the input image in node 111
+TEMPLATE = {
+    "4": {
+        "inputs": {"ckpt_name": "sd_xl_base_1.0.safetensors"},
+        "class_type": "CheckpointLoaderSimple",
+    },
+    "6": {
+        "inputs": {"text": "oil painting", "clip": ["4", 1]},
+        "class_type": "CLIPTextEncode",
+    },
+    "111": {
+        "inputs": {"url_or_path": "/workspace/ComfyUI/input/example.png"},
+        "class_type": "LoadImageFromUrlOrPath",
+    },
+    "12": {
+        "inputs": {"pixels": ["111", 0], "vae": ["4", 2]},
+        "class_type": "VAEEncode",
+    },
+    "3": {
+        "inputs": {
+            "seed": 1,
+            "cfg": 8.0,
+            "model": ["4", 0],
+            "positive": ["6", 0],
+            "latent_image": ["12", 0],
+        },
+        "class_type": "KSampler",
+    },
+    "8": {
+        "inputs": {"samples": ["3", 0], "vae": ["4", 2]},
+        "class_type": "VAEDecode",
+    },
+    "9": {
+        "inputs": {"filename_prefix": "ComfyUI", "images": ["8", 0]},
+        "class_type": "SaveImage",
+    },
+}
+
+
+# Output nodes of custom nodes, only known once a backend reported them in /object_info
+CUSTOM_OUTPUTS = {
+    "1": {"inputs": {"image": "example.png"}, "class_type": "LoadImage"},
+    "2": {"inputs": {"images": ["1", 0]}, "class_type": "SaveImage"},
+    "3": {"inputs": {"images": ["1", 0]}, "class_type": "VHS_VideoCombine"},
+    "4": {"inputs": {"images": ["1", 0]}, "class_type": "SaveImageWebsocket"},
+}
+
+
+def known_output_nodes(test, host="127.0.0.1:8188"):
+    """
+    Makes both copies of workflow_binder, as src.workflow_binder and as imported by
+    the handler, strip dead nodes until the test ends, as if host reported its output nodes
+    """
+    for module in {workflow_binder, sys.modules["workflow_binder"]}:
+        if host not in module.output_node_hosts:
+            module.output_node_hosts.add(host)
+            test.addCleanup(module.output_node_hosts.discard, host)
+
+
+class TestWorkflowBinder(unittest.TestCase):
+    def test_canonicalize(self):
+        workflow = {
+            10: {
+                "inputs": {"vae_name": "ae.safetensors"},
+                "class_type": "VAELoader",
+                "_meta": {"title": "Load VAE"},
+            },
+            "8": {"inputs": {"vae": [10, 0], "cfg": 8.0}, "class_type": "VAEDecode"},
+        }
+
+        result = workflow_binder.canonicalize(workflow)
+
+        self.assertEqual(list(result), ["8", "10"])
+        self.assertEqual(result["8"]["inputs"], {"cfg": 8, "vae": ["10", 0]})
+        self.assertNotIn("_meta", result["10"])
+
+    def test_strip_dead_nodes(self):
+        known_output_nodes(self)
+        workflow = workflow_binder.canonicalize(TEMPLATE)
+        workflow["7"] = {
+            "inputs": {"text": "unused", "clip": ["4", 1]},
+            "class_type": "CLIPTextEncode",
+        }
+
+        result = workflow_binder.strip_dead_nodes(workflow)
+
+        self.assertEqual(set(result), set(TEMPLATE))
+
+    def test_keep_nodes_until_output_nodes_are_loaded(self):
+        workflow = workflow_binder.canonicalize(CUSTOM_OUTPUTS)
+
+        with patch.object(workflow_binder, "output_node_hosts", set()):
+            self.assertEqual(workflow_binder.strip_dead_nodes(workflow), workflow)
+
+    def test_handler_loads_output_nodes(self):
+        fake = FakeComfyUI().start()
+        self.addCleanup(fake.stop)
+        pool = BackendPool(parse_backends(fake.host, "/out"))
+        pool.check_all()
+        binder = sys.modules["workflow_binder"]
+        self.addCleanup(binder.output_node_hosts.discard, fake.host)
+
+        with patch.object(rp_handler, "pool", pool), patch.object(
+            rp_handler, "graph", rp_handler.WorkflowGraph()
+        ) as graph:
+            rp_handler.load_output_nodes()
+            bound = graph.bind(CUSTOM_OUTPUTS)
+
+        self.assertIn(fake.host, binder.output_node_hosts)
+        self.assertEqual(sorted(bound.workflow), ["1", "2", "3", "4"])
+
+    def test_keep_nodes_without_output_node(self):
+        workflow = {"1": {"inputs": {}, "class_type": "UnknownNode"}}
+
+        self.assertEqual(workflow_binder.strip_dead_nodes(workflow), workflow)
+
+    def test_url_change_keeps_loaders_and_encoders_cached(self):
+        first = workflow_binder.prepare_workflow(TEMPLATE)
+        second = workflow_binder.prepare_workflow(TEMPLATE)
+        second["111"]["inputs"]["url_or_path"] = "https://example.com/cat.png"
+
+        predicted = workflow_binder.predict_cached(
+            workflow_binder.node_signatures(second), workflow_binder.node_signatures(first)
+        )
+
+        self.assertEqual(predicted, ["4", "6"])
+
+    def test_template_name(self):
+        workflow = workflow_binder.prepare_workflow(TEMPLATE)
+        changed = workflow_binder.prepare_workflow(TEMPLATE)
+        changed["6"]["inputs"]["text"] = "watercolor"
+
+        self.assertEqual(
+            workflow_binder.template_name({}, workflow, "/workspace/workflow.json"),
+            "workflow",
+        )
+        self.assertEqual(
+            workflow_binder.template_name({"workflow": TEMPLATE}, workflow, ""),
+            workflow_binder.template_name({"workflow": TEMPLATE}, changed, ""),
+        )
+
+    def test_cached_nodes(self):
+        history = {
+            "status": {
+                "messages": [
+                    ["execution_start", {"prompt_id": "123"}],
+                    ["execution_cached", {"nodes": ["4", 6], "prompt_id": "123"}],
+                ]
+            }
+        }
+
+        self.assertEqual(workflow_binder.cached_nodes(history), ["4", "6"])
+        self.assertEqual(workflow_binder.cached_nodes({}), [])
+
+    def test_load_template_returns_copies(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as file:
+            json.dump(TEMPLATE, file)
+        self.addCleanup(os.remove, file.name)
+
+        first = workflow_binder.load_template(file.name)
+        first["111"]["inputs"]["url_or_path"] = "changed"
+        second = workflow_binder.load_template(file.name)
+
+        self.assertEqual(
+            second["111"]["inputs"]["url_or_path"], "/workspace/ComfyUI/input/example.png"
+        )
+
+    def test_handler_reports_cached_nodes(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as file:
+            json.dump(TEMPLATE, file)
+        self.addCleanup(os.remove, file.name)
+        fake = FakeComfyUI().start()
+        self.addCleanup(fake.stop)
+        pool = BackendPool(parse_backends(fake.host, "/out"))
+        pool.check_all()
+
+        with patch.object(rp_handler, "pool", pool), patch.object(
+            rp_handler, "scheduler", ModelAffinityScheduler(pool)
+        ), patch.object(
+            rp_handler, "COMFY_WORKFLOW_PATH", file.name
+        ), patch.object(
+            rp_handler, "process_output_images", return_value={"status": "success"}
+        ):
+            rp_handler.handler({"id": "1", "input": {"url": "https://example.com/1.png"}})
+            result = rp_handler.handler(
+                {"id": "2", "input": {"url": "https://example.com/2.png"}}
+            )
+
+        cache = result["metrics"]["cache"]
+        self.assertEqual(cache["predicted_cached"], ["4", "6"])
+        self.assertEqual(cache["cached"], ["4", "6"])
+        self.assertEqual(cache["mispredicted"], [])
+        self.assertIn("111", cache["executed"])
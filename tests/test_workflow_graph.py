@@ -0,0 +1,96 @@
+import unittest
+import sys
+import os
+import copy
+import json
+
+# Make sure that "src" is known and can be used to import workflow_graph.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from src import workflow_binder
+from src.scheduler import extract_models
+from src.workflow_graph import WorkflowGraph
+from tests.test_workflow_binder import TEMPLATE, known_output_nodes
+
+
+class TestWorkflowGraph(unittest.TestCase):
+    def setUp(self):
+        known_output_nodes(self)
+        self.graph = WorkflowGraph()
+
+    def assertBoundLikePrepared(self, bound, workflow):
+        prepared = workflow_binder.prepare_workflow(workflow)
+        self.assertEqual(list(bound.workflow), list(prepared))
+        self.assertEqual(bound.workflow, prepared)
+        self.assertEqual(bound.serialized, json.dumps(prepared))
+        self.assertEqual(bound.signatures, workflow_binder.node_signatures(prepared))
+        self.assertEqual(bound.models, extract_models(prepared))
+        self.assertEqual(bound.structure, workflow_binder.structure_id(prepared))
+
+    def test_only_changed_nodes_are_processed(self):
+        first = self.graph.bind(TEMPLATE)
+        workflow = copy.deepcopy(TEMPLATE)
+        workflow["111"]["inputs"]["url_or_path"] = "https://example.com/cat.png"
+
+        second = self.graph.bind(workflow)
+
+        self.assertEqual(len(first.changed), len(TEMPLATE))
+        self.assertEqual(second.changed, ["111"])
+        self.assertEqual(self.graph.bind(workflow).changed, [])
+        self.assertBoundLikePrepared(second, workflow)
+        for node_id in ["4", "6"]:
+            self.assertEqual(second.signatures[node_id], first.signatures[node_id])
+        for node_id in ["111", "12", "3", "8", "9"]:
+            self.assertNotEqual(second.signatures[node_id], first.signatures[node_id])
+
+    def test_added_removed_and_dead_nodes(self):
+        self.graph.bind(TEMPLATE)
+        workflow = copy.deepcopy(TEMPLATE)
+        workflow["7"] = {"inputs": {"text": "unused", "clip": [4, 1]}, "class_type": "CLIPTextEncode"}
+        self.assertBoundLikePrepared(self.graph.bind(workflow), workflow)
+
+        del workflow["6"]
+        workflow["3"]["inputs"]["positive"] = ["7", 0]
+        workflow["4"]["inputs"]["ckpt_name"] = "flux1-dev.safetensors"
+        bound = self.graph.bind(workflow)
+
+        self.assertEqual(sorted(bound.changed), ["3", "4"])
+        self.assertBoundLikePrepared(bound, workflow)
+
+    def test_invalid_workflow_keeps_previous_graph(self):
+        self.graph.bind(TEMPLATE)
+        workflow = copy.deepcopy(TEMPLATE)
+        del workflow["4"]
+
+        with self.assertRaises(ValueError):
+            self.graph.bind(workflow)
+        with self.assertRaises(ValueError):
+            self.graph.bind({"1": {"inputs": {}}})
+
+        self.assertEqual(self.graph.bind(TEMPLATE).changed, [])
+
+    def test_new_output_nodes_relink_unchanged_workflow(self):
+        workflow = copy.deepcopy(TEMPLATE)
+        workflow["7"] = {"inputs": {"images": ["8", 0]}, "class_type": "CustomSave"}
+        self.assertNotIn("7", self.graph.bind(workflow).workflow)
+
+        output_node_classes = sys.modules["workflow_binder"].output_node_classes
+        output_node_classes.add("CustomSave")
+        self.addCleanup(output_node_classes.discard, "CustomSave")
+
+        self.assertIn("7", self.graph.bind(workflow).workflow)
+
+    def test_handler_rejects_workflow_that_is_not_an_object(self):
+        for workflow in [["9"], "workflow", 42]:
+            result = rp_handler.handler({"id": "123", "input": {"workflow": workflow}})
+
+            self.assertEqual(result, {"error": "Invalid workflow: the workflow is not an object"})
+
+    def test_handler_rejects_invalid_workflow(self):
+        workflow = {"9": {"inputs": {"images": ["8", 0]}, "class_type": "SaveImage"}}
+
+        result = rp_handler.handler({"id": "123", "input": {"workflow": workflow}})
+
+        self.assertEqual(
+            result, {"error": "Invalid workflow: input 'images' of node 9 links to missing node 8"}
+        )